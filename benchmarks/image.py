@@ -0,0 +1,246 @@
+"""
+Benchmark the image utilities on generated images across modes and sizes, and flag regressions against a baseline.
+
+Run from the repo root with `python benchmarks/image.py`. Every case runs in a freshly forked process, so its peak
+memory is the growth of the resident set size while it runs, which also covers Pillow's own buffers that
+tracemalloc doesn't see. Times are per call, over `--repeat` runs of enough calls to last at least 100 ms each,
+and at least 10 runs for the cases under a millisecond, whose timings are the noisiest.
+
+Compare against `benchmarks/baselines/image.json` (the default) to flag the cases whose fastest run got slower, or
+whose peak memory grew, beyond `--tolerance` plus a small absolute slack, exiting with status 1 if any did.
+Baselines only make sense on the machine they were recorded on, so they aren't committed: record one with
+`--save-baseline` before a Pillow upgrade or a refactor, and compare after it. A baseline recorded on another CPU,
+Python or Pillow is reported but not compared against.
+"""
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import platform
+import resource
+import statistics
+import numpy as np
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageChops, __version__ as PILLOW_VERSION
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'packages', 'whatsapp', 'webhook'))
+
+from utils.context import ActivationContext
+from utils.image import autocrop_image, convert_png_to_jpeg, resize_dimensions, resize_image, parse_image_caption
+
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'image.json')
+# A thumbnail, WhatsApp's compressed photos, and a 12 MP phone camera
+SIZES = [(640, 480), (1600, 1200), (4032, 3024)]
+MODES = ['RGBA', 'P', 'L', 'CMYK']
+# Modes with transparency, the only ones autocropped in practice
+TRANSPARENT_MODES = ['RGBA', 'P']
+CAPTIONS = {
+    'i2t': '',
+    'bg': '/bg bgcolor=red',
+    'i2a': '/i2a bg bgcolor=black w=120 complex negative flipx',
+}
+# Fast functions are called repeatedly in each timed run, so their time isn't lost in the timer's resolution, and
+# timed more times, since a scheduler hiccup or a frequency change weighs more on them
+MIN_RUN_SECONDS = 0.1
+FAST_CASE_SECONDS = 0.001
+FAST_CASE_MIN_REPEAT = 10
+# Slack for the time comparison, below which differences are noise rather than regressions
+TIME_SLACK_US = 50.0
+# Slack for the peak memory comparison, since the resident set size grows in whole pages
+MEMORY_SLACK_MIB = 1.0
+
+
+def generate_image(mode: str, width: int, height: int) -> BytesIO:
+    """
+    Generate an image of the given mode as the webhook would receive it: a PNG, or a JPEG for CMYK. Images with
+    transparency get a transparent border for autocrop to remove
+    """
+    # Built at low resolution and upscaled, so generating it stays fast even at 12 MP
+    y, x = np.mgrid[0:height // 16, 0:width // 16].astype(np.float32)
+    gradient = np.stack([60 + 150 * x / x.max(), 90 + 120 * y / y.max(), 220 - 140 * x / x.max()], axis=-1)
+    image = Image.fromarray(gradient.astype(np.uint8)).resize((width, height), Image.Resampling.BILINEAR)
+    image = ImageChops.add(image, Image.effect_noise((width, height), 8).convert('RGB'), offset=-128)
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((width * 0.25, height * 0.2, width * 0.6, height * 0.7), fill=(230, 200, 40))
+    for row in range(8):
+        top = height * (0.3 + row * 0.06)
+        draw.rectangle((width * 0.62, top, width * 0.85, top + height * 0.02), fill=(20, 20, 30))
+    border = (width // 10, height // 10, width - width // 10, height - height // 10)
+    if mode == 'RGBA':
+        canvas = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+        canvas.paste(image.crop(border), border[:2])
+        image = canvas
+    elif mode == 'P':
+        # The last palette entry is left free to mark the transparent border
+        quantized = image.crop(border).quantize(colors=255)
+        canvas = Image.new('P', (width, height), 255)
+        canvas.putpalette(quantized.getpalette()[:255 * 3] + [0, 0, 0])
+        canvas.paste(quantized, border[:2])
+        image = canvas
+    else:
+        image = image.convert(mode)
+    buffer = BytesIO()
+    if mode == 'CMYK':
+        image.save(buffer, 'JPEG', quality=90)
+    elif mode == 'P':
+        image.save(buffer, 'PNG', transparency=255, compress_level=1)
+    else:
+        image.save(buffer, 'PNG', compress_level=1)
+    return buffer
+
+
+def generate_images(sizes: list[tuple[int, int]]) -> dict[str, bytes]:
+    """
+    Generate the image of every mode and size, labeled as `<mode>-<width>x<height>`
+    """
+    return {f'{mode}-{width}x{height}': generate_image(mode, width, height).getvalue() for width, height in sizes for mode in MODES}
+
+
+def get_cases(images: dict[str, bytes]) -> dict:
+    """
+    Get the function of every benchmark case, by name
+    """
+    ctx = ActivationContext('benchmark')
+    cases = {}
+    for name, caption in CAPTIONS.items():
+        cases[f'parse_image_caption[{name}]'] = lambda caption=caption: parse_image_caption(caption)
+    cases['resize_dimensions'] = lambda: resize_dimensions(4032, 3024, tgt_width=120)
+    for label, image in images.items():
+        cases[f'resize_image[{label}]'] = lambda image=image: resize_image(BytesIO(image), tgt_width=120)
+        if label.split('-')[0] in TRANSPARENT_MODES:
+            cases[f'autocrop_image[{label}]'] = lambda image=image: autocrop_image(BytesIO(image), border=10)
+        cases[f'convert_png_to_jpeg[{label}]'] = lambda image=image: convert_png_to_jpeg(BytesIO(image), None, ctx=ctx)
+    return cases
+
+
+def get_rss_mib() -> float:
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def measure(func, repeat: int) -> dict:
+    """
+    Run a case in the current process: once to measure its peak memory, then `repeat` times to time it
+    """
+    rss_before = get_rss_mib()
+    start = time.perf_counter()
+    func()
+    first_call_seconds = time.perf_counter() - start
+    peak_mib = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - rss_before, 0)
+    calls = max(1, int(MIN_RUN_SECONDS / max(first_call_seconds, 1e-9)))
+    if first_call_seconds < FAST_CASE_SECONDS:
+        repeat = max(repeat, FAST_CASE_MIN_REPEAT)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        timings.append((time.perf_counter() - start) * 1e6 / calls)
+    return {'time_us': statistics.median(timings), 'min_time_us': min(timings), 'peak_mib': peak_mib}
+
+
+def run_forked(func, *args):
+    """
+    Run a function in a forked process, which starts with a fresh peak resident set size and leaves this process'
+    memory untouched. Exceptions are returned as an `error` dict
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        try:
+            result = func(*args)
+        except Exception as e:
+            result = {'error': f'{type(e).__name__}: {e}'}
+        with os.fdopen(write_end, 'wb') as pipe:
+            pickle.dump(result, pipe)
+        os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end, 'rb') as pipe:
+        output = pipe.read()
+    os.waitpid(pid, 0)
+    return pickle.loads(output) if output else {'error': 'The benchmark process died'}
+
+
+def compare(name: str, result: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Get the regressions of a case against its baseline
+    """
+    regressions = []
+    if 'error' in result or name not in baseline:
+        return regressions
+    previous = baseline[name]
+    if result['min_time_us'] > previous['min_time_us'] * (1 + tolerance) + TIME_SLACK_US:
+        regressions.append(f"time {previous['min_time_us']:,.1f} -> {result['min_time_us']:,.1f} us")
+    if result['peak_mib'] > previous['peak_mib'] * (1 + tolerance) + MEMORY_SLACK_MIB:
+        regressions.append(f"peak {previous['peak_mib']:.1f} -> {result['peak_mib']:.1f} MiB")
+    return regressions
+
+
+def get_cpu_model() -> str:
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def get_environment() -> dict:
+    return {
+        'python': platform.python_version(),
+        'pillow': PILLOW_VERSION,
+        'machine': platform.machine(),
+        'system': platform.system(),
+        'cpu': get_cpu_model(),
+        'cpus': os.cpu_count(),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help="Timed runs per case (default: 5)")
+    parser.add_argument('--filter', help="Only run the cases whose name contains this")
+    parser.add_argument('--max-size', type=int, default=len(SIZES), help=f"Only run the first N sizes of {SIZES} (default: all)")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="Baseline JSON to compare against (default: benchmarks/baselines/image.json)")
+    parser.add_argument('--save-baseline', action='store_true', help="Write the results to the baseline instead of comparing against it")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Relative slowdown or memory growth flagged as a regression (default: 0.25)")
+    args = parser.parse_args()
+    baseline = {}
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            stored = json.load(baseline_file)
+        baseline = stored['results']
+        if stored['environment'] != get_environment():
+            print(f"Not comparing against the baseline, recorded on {stored['environment']} rather than {get_environment()}")
+            baseline = {}
+    # Generated in a child, so the memory the generation leaves behind doesn't hide the growth of the cases
+    cases = get_cases(run_forked(generate_images, SIZES[:args.max_size]))
+    results = {}
+    regressed = []
+    print(f"{'case':<42} {'median us':>14} {'min us':>14} {'peak MiB':>9}  regressions")
+    for name, func in cases.items():
+        if args.filter and args.filter not in name:
+            continue
+        result = results[name] = run_forked(measure, func, args.repeat)
+        if 'error' in result:
+            print(f"{name:<42} {result['error']}")
+            continue
+        regressions = compare(name, result, baseline, args.tolerance)
+        if regressions:
+            regressed.append(name)
+        print(f"{name:<42} {result['time_us']:>14,.1f} {result['min_time_us']:>14,.1f} {result['peak_mib']:>9.1f}  {', '.join(regressions)}")
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as baseline_file:
+            json.dump({'environment': get_environment(), 'results': results}, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+        print(f"Saved the baseline of {len(results)} cases to {args.baseline}")
+    elif baseline:
+        print(f"{len(regressed)} of {len(results)} cases regressed beyond {args.tolerance:.0%}")
+    sys.exit(1 if regressed else 0)
@@ -0,0 +1,63 @@
+"""
+Benchmark the latency and peak memory of the local background removal at typical phone photo sizes.
+
+Run from the repo root with `python benchmarks/segmentation.py`. Peak memory is the peak traced by tracemalloc,
+which covers the NumPy arrays, plus the peak resident set size of the whole process at the end of each size.
+"""
+import os
+import sys
+import time
+import argparse
+import resource
+import statistics
+import tracemalloc
+import numpy as np
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageChops
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'packages', 'whatsapp', 'webhook'))
+
+from utils.segmentation import remove_background
+
+
+# WhatsApp's compressed photos, a 12 MP phone camera, and its portrait orientation
+SIZES = [(1600, 1200), (4032, 3024), (3024, 4032)]
+
+
+def generate_photo(width: int, height: int) -> BytesIO:
+    """
+    Generate a JPEG of a subject over a noisy, unevenly lit background, roughly like a phone photo
+    """
+    # Built with Pillow at low resolution and upscaled, so generating it barely moves the process' peak memory
+    y, x = np.mgrid[0:height // 16, 0:width // 16].astype(np.float32)
+    gradient = np.stack([170 + 40 * x / x.max(), 180 + 30 * y / y.max(), 200 - 30 * x / x.max()], axis=-1)
+    image = Image.fromarray(gradient.astype(np.uint8)).resize((width, height), Image.Resampling.BILINEAR)
+    noise = Image.effect_noise((width, height), 6).convert("RGB")
+    image = ImageChops.add(image, noise, offset=-128)
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((width * 0.3, height * 0.2, width * 0.7, height * 0.75), fill=(200, 60, 50))
+    draw.rectangle((width * 0.45, height * 0.7, width * 0.55, height * 0.95), fill=(50, 50, 60))
+    jpeg_buffer = BytesIO()
+    image.save(jpeg_buffer, "JPEG", quality=90)
+    return jpeg_buffer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per size (default: 5)")
+    args = parser.parse_args()
+    print(f"{'size':>11} {'median ms':>10} {'min ms':>8} {'traced peak MiB':>16} {'max RSS MiB':>12}")
+    for width, height in SIZES:
+        photo = generate_photo(width, height)
+        timings = []
+        traced_peak = 0
+        for _ in range(args.repeat):
+            photo.seek(0)
+            tracemalloc.start()
+            start = time.perf_counter()
+            remove_background(photo)
+            timings.append((time.perf_counter() - start) * 1000)
+            traced_peak = max(traced_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"{f'{width}x{height}':>11} {statistics.median(timings):>10.0f} {min(timings):>8.0f} {traced_peak / 2 ** 20:>16.1f} {max_rss:>12.0f}")
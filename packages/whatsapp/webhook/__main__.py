@@ -1,8 +1,15 @@
 import os
 import json
+import asyncio
 import logging
 from time import sleep
+from utils.aio import call, request_scope
+from utils.lanes import LaneScheduler, classify_message, call_in_lane
+from utils.profiling import profiled
+from utils.warmup import timed_first_message
+from utils.metrics import increment, timed, flush_metrics
 from utils.media import MediaProcessingError
+from utils.services import ServiceUnavailableError, call_deadline
 from utils.logging import log_to_redis, init_logging
 from utils.vision import alter_image, ImageProcessingError
 from utils.messaging import mark_as_read, send_text, send_media
@@ -67,6 +74,15 @@ def process_text(message: dict, metadata: dict, ctx):
             voice_short_name = text.split(' ')[2]
             voices = get_voice_list()
             voice = next((voice for voice in voices if voice['short_name'] == voice_short_name), None)
+            if voice is None:
+                logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Replying with unknown voice {voice_short_name}")
+                send_text(
+                    phone_number_id=metadata['phone_number_id'],
+                    sender=f'+{message["from"]}',
+                    text=f"No encontré la voz `{voice_short_name}`. Envía `/tts get_voices` para ver las voces disponibles.",
+                    reply_to_id=message['id']
+                )
+                return
             save_voice(sender=message['from'], voice=voice)
             logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Replying with voice set confirmation")
             send_text(
@@ -141,64 +157,131 @@ def process_unsupported(message: dict, metadata: dict, ctx):
     )
 
 
-def process_change(change: dict, ctx: dict):
+async def process_message(message: dict, metadata: dict, ctx):
     """
-    Process a change event
+    Process a single message, replying with the error if it fails
     """
-    if 'value' not in change or 'messages' not in change['value'] or 'metadata' not in change['value'] or len(change['value']['messages']) == 0:
-        logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Skipped change: %s", change)
-        return
-    logger.info(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Processing new change with {len(change['value']['messages'])} messages")
-    logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Change: {json.dumps(change)}")
-    value = change['value']
-    messages = value['messages']
-    metadata = value['metadata']
-    for message in messages:
-        mark_as_read(phone_number_id=metadata['phone_number_id'], message_id=message['id'])
-        log_to_redis(key=ctx.activation_id, value=message['from'])
-        try:
-            if message['type'] == 'audio':
-                logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Processing audio message: {json.dumps(message)}")
-                process_audio(message, metadata, ctx)
-            elif message['type'] == 'text':
-                logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Processing text message: {json.dumps(message)}")
-                process_text(message, metadata, ctx)
-            elif message['type'] == 'image':
-                logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Processing image message: {json.dumps(message)}")
-                process_image(message, metadata, ctx)
-            else:
-                logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Processing unsupported message: {json.dumps(message)}")
-                process_unsupported(message, metadata, ctx)
-        except (MediaProcessingError, ImageProcessingError) as e:
-            send_text(
+    increment('messages_total', type=message['type'])
+    try:
+        with timed('message_duration_ms', type=message['type']), timed_first_message(message['type']):
+            await dispatch_message(message, metadata, ctx)
+    except (MediaProcessingError, ImageProcessingError, ServiceUnavailableError) as e:
+        increment('message_errors_total', type=message['type'], error=type(e).__name__)
+        # The reply about the error may use the time kept for it
+        with call_deadline(ctx, margin=0):
+            await call(
+                send_text,
                 phone_number_id=metadata['phone_number_id'],
                 sender=f'+{message["from"]}',
                 text=str(e),
                 reply_to_id=message['id']
             )
-        except Exception as e:
-            send_text(
+    except Exception as e:
+        increment('message_errors_total', type=message['type'], error=type(e).__name__)
+        with call_deadline(ctx, margin=0):
+            await call(
+                send_text,
                 phone_number_id=metadata['phone_number_id'],
                 sender=f'+{message["from"]}',
                 text=f"Lo siento, algo salió mal al procesar tu mensaje. Por favor, intenta de nuevo más tarde. Si el problema persiste, contacta a soporte con la siguiente info: `actv_id = {ctx.activation_id}, remaining_ms = {ctx.get_remaining_time_in_millis()}`",
                 reply_to_id=message['id']
             )
-            raise e
+        raise e
 
 
-def process_event(event: dict, ctx: dict):
+async def dispatch_message(message: dict, metadata: dict, ctx):
+    """
+    Hand a message to the processor for its type
+    """
+    if message['type'] == 'audio':
+        logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Processing audio message: {json.dumps(message)}")
+        await call_in_lane(process_audio, message, metadata, ctx)
+    elif message['type'] == 'text':
+        logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Processing text message: {json.dumps(message)}")
+        await call_in_lane(process_text, message, metadata, ctx)
+    elif message['type'] == 'image':
+        logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Processing image message: {json.dumps(message)}")
+        await call_in_lane(process_image, message, metadata, ctx)
+    else:
+        logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Processing unsupported message: {json.dumps(message)}")
+        await call_in_lane(process_unsupported, message, metadata, ctx)
+
+
+async def handle_message(message: dict, metadata: dict, ctx):
+    """
+    Process a message, overlapping its read receipt and audit record with its processing
+    """
+    side_calls = [
+        asyncio.create_task(call(mark_as_read, phone_number_id=metadata['phone_number_id'], message_id=message['id'])),
+        asyncio.create_task(call(log_to_redis, key=ctx.activation_id, value=message['from'])),
+    ]
+    try:
+        await process_message(message, metadata, ctx)
+    finally:
+        for result in await asyncio.gather(*side_calls, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Failed to mark message as read or log it: %s", result, exc_info=result)
+
+
+async def process_change_async(change: dict, ctx, scheduler: LaneScheduler | None = None):
+    """
+    Process a change event, scheduling each message in the lane of its expected cost. Without a scheduler of the
+    whole request, it waits for its own messages
+    """
+    if 'value' not in change or 'messages' not in change['value'] or 'metadata' not in change['value'] or len(change['value']['messages']) == 0:
+        logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Skipped change: %s", change)
+        return
+    logger.info(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Processing new change with {len(change['value']['messages'])} messages")
+    logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Change: {json.dumps(change)}")
+    value = change['value']
+    messages = value['messages']
+    metadata = value['metadata']
+    own_scheduler = scheduler is None
+    if own_scheduler:
+        scheduler = LaneScheduler()
+    for message in messages:
+        lane = classify_message(message)
+        logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Scheduling message {message['id']} in the {lane} lane")
+        scheduler.submit(message['from'], lane, handle_message, message, metadata, ctx)
+    if own_scheduler:
+        await scheduler.join()
+
+
+def process_change(change: dict, ctx):
+    """
+    Process a change event
+    """
+    async def run():
+        async with request_scope():
+            with call_deadline(ctx):
+                await process_change_async(change, ctx)
+    asyncio.run(run())
+
+
+async def process_event_async(event: dict, ctx):
     if 'entry' not in event or len(event['entry']) == 0:
         return
     entries = event['entry']
-    for entry in entries:
-        if 'changes' not in entry or len(entry['changes']) == 0:
-            return
-        changes = entry['changes']
-        for change in changes:
-            if change['field'] == 'messages':
-                process_change(change, ctx)
+    async with request_scope():
+        with call_deadline(ctx):
+            scheduler = LaneScheduler()
+            try:
+                for entry in entries:
+                    if 'changes' not in entry or len(entry['changes']) == 0:
+                        return
+                    changes = entry['changes']
+                    for change in changes:
+                        if change['field'] == 'messages':
+                            await process_change_async(change, ctx, scheduler)
+            finally:
+                await scheduler.join()
+
+
+def process_event(event: dict, ctx):
+    asyncio.run(process_event_async(event, ctx))
 
 
+@profiled
 def main(event: dict, ctx) -> dict:
     init_logging()
     logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Received event: {json.dumps(event)}")
@@ -212,4 +295,6 @@ def main(event: dict, ctx) -> dict:
             logger.error(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Failed to process the request: %s", e, exc_info=True, stack_info=True)
             clean_event = {key: value for key, value in event.items() if not (key.startswith('__ow') or key == 'http')}
             logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Request body: {json.dumps(clean_event)}")
+        finally:
+            flush_metrics()
         return EMPTY_200_RESPONSE
@@ -0,0 +1,152 @@
+"""
+Serve the webhook over HTTP from a long-running process, outside of DO Functions.
+
+`application` is a WSGI app, so it can run behind any WSGI server, e.g.
+`gunicorn --chdir packages/whatsapp/webhook --workers 4 --threads 8 --graceful-timeout 35 server:application`.
+Running this file directly starts a built-in pre-forked server instead, e.g. `python server.py --port 8080 --workers 4`.
+Either way each worker keeps its HTTP sessions, Redis and Spaces clients warm across requests.
+"""
+import os
+import sys
+import json
+import signal
+import logging
+import argparse
+import threading
+import importlib.util
+from http import HTTPStatus
+from urllib.parse import parse_qsl
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+WEBHOOK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, WEBHOOK_DIR)
+
+from utils.context import ActivationContext
+
+
+logger = logging.getLogger('server')
+SERVER_DEADLINE_MS = int(os.getenv('SERVER_DEADLINE_MS', 30000))
+MAX_BODY_BYTES = 4 * 1024 * 1024
+
+
+def load_webhook():
+    """
+    Load the webhook's `__main__.py` as a regular module
+    """
+    spec = importlib.util.spec_from_file_location('webhook', os.path.join(WEBHOOK_DIR, '__main__.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+webhook = load_webhook()
+
+
+def build_event(environ: dict) -> dict:
+    """
+    Build the event DO Functions would pass to a web action: query parameters and JSON body fields at the top
+    level, and the request details under `http`
+    """
+    headers = {key[5:].replace('_', '-').lower(): value for key, value in environ.items() if key.startswith('HTTP_')}
+    if environ.get('CONTENT_TYPE'):
+        headers['content-type'] = environ['CONTENT_TYPE']
+    event = dict(parse_qsl(environ.get('QUERY_STRING', ''), keep_blank_values=True))
+    content_length = int(environ.get('CONTENT_LENGTH') or 0)
+    if content_length > MAX_BODY_BYTES:
+        raise ValueError(f"Request body of {content_length} bytes exceeds the {MAX_BODY_BYTES} bytes limit")
+    body = environ['wsgi.input'].read(content_length) if content_length else b''
+    if body:
+        payload = json.loads(body)
+        if isinstance(payload, dict):
+            event.update(payload)
+    event['http'] = {
+        'method': environ['REQUEST_METHOD'],
+        'path': environ.get('PATH_INFO', '/'),
+        'headers': headers,
+    }
+    return event
+
+
+def application(environ: dict, start_response):
+    ctx = ActivationContext(deadline_ms=SERVER_DEADLINE_MS)
+    try:
+        event = build_event(environ)
+    except ValueError as e:
+        # Also covers malformed JSON bodies
+        logger.warning(f"ActvID {ctx.activation_id} Rejected request: {e}")
+        start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+        return [b'Invalid request']
+    result = webhook.main(event, ctx)
+    status = int(result.get('statusCode', 200))
+    body = result.get('body', '')
+    body = body if isinstance(body, (bytes, str)) else json.dumps(body)
+    body = body.encode('utf-8') if isinstance(body, str) else body
+    start_response(f'{status} {HTTPStatus(status).phrase}', list(result.get('headers', {}).items()))
+    return [body]
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    # Non-daemon request threads make server_close wait for the requests in flight
+    daemon_threads = False
+    block_on_close = True
+    # Every worker binds the same port and the kernel balances the connections between them
+    allow_reuse_port = True
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def run_worker(host: str, port: int):
+    server = ThreadingWSGIServer((host, port), QuietRequestHandler)
+    server.set_app(application)
+
+    def stop(signum, frame):
+        # shutdown blocks until serve_forever returns, so it can't run on the thread serving
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info(f"Worker {os.getpid()} serving on {host}:{port}")
+    server.serve_forever()
+    server.server_close()
+    logger.info(f"Worker {os.getpid()} stopped")
+
+
+def serve(host: str, port: int, workers: int):
+    """
+    Fork the workers and wait for them, relaying termination signals so they finish their requests in flight
+    """
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(host, port)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='0.0.0.0', help="Address to listen on (default: 0.0.0.0)")
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORT', 8080)), help="Port to listen on (default: $PORT or 8080)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Worker processes (default: one per CPU)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    serve(args.host, args.port, args.workers)
@@ -0,0 +1,109 @@
+import os
+import asyncio
+import logging
+import threading
+from functools import wraps, partial
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from contextlib import asynccontextmanager
+from utils.metrics import increment
+from utils.profiling import run_profiled
+
+
+logger = logging.getLogger(__name__)
+# Shared by every request of the process, for the blocking calls made outside of the message lanes
+IO_THREADS = int(os.getenv('IO_THREADS') or 32)
+_io_executor = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix='io')
+
+
+class RequestScope:
+    """
+    State shared by every call made while handling a single request: the event loop running it, the results of
+    coalesced calls, and the background calls that must finish before the request is done
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.lock = threading.Lock()
+        self.calls: dict[tuple, Future] = {}
+        self.background: list[Future] = []
+
+
+_request_scope: ContextVar[RequestScope | None] = ContextVar('request_scope', default=None)
+
+
+@asynccontextmanager
+async def request_scope():
+    """
+    Open a request scope, and wait for every background call made in it before closing it
+    """
+    scope = RequestScope(asyncio.get_running_loop())
+    token = _request_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        while scope.background:
+            with scope.lock:
+                pending, scope.background = scope.background, []
+            results = await asyncio.gather(*(asyncio.wrap_future(future) for future in pending), return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"Background call failed: {result}", exc_info=result)
+        _request_scope.reset(token)
+
+
+async def call_in(executor: ThreadPoolExecutor, func, *args, **kwargs):
+    """
+    Run a blocking function in a thread of the given pool, with the context of the caller
+    """
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(copy_context().run, run_profiled, func, *args, **kwargs))
+
+
+async def call(func, *args, **kwargs):
+    """
+    Run a blocking I/O function in a worker thread, so other calls of the request can overlap with it
+    """
+    # Like asyncio.to_thread, but the loop's default pool would be recreated on every request
+    return await call_in(_io_executor, func, *args, **kwargs)
+
+
+def defer(func, *args, **kwargs) -> None:
+    """
+    Run a blocking I/O function in the background of the current request, which waits for it before finishing.
+    Outside of a request scope the function just runs inline
+    """
+    scope = _request_scope.get()
+    if scope is None:
+        func(*args, **kwargs)
+        return
+    future = asyncio.run_coroutine_threadsafe(call(func, *args, **kwargs), scope.loop)
+    with scope.lock:
+        scope.background.append(future)
+
+
+def coalesced(func):
+    """
+    Make concurrent and repeated calls with the same arguments within a request share a single call. Outside of a
+    request scope every call goes through
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        scope = _request_scope.get()
+        if scope is None:
+            return func(*args, **kwargs)
+        key = (func.__module__, func.__qualname__, args, tuple(sorted(kwargs.items())))
+        with scope.lock:
+            future = scope.calls.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = scope.calls[key] = Future()
+        increment('cache_requests_total', cache='coalesced_calls', result='miss' if is_owner else 'hit')
+        if not is_owner:
+            return future.result()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result
+    return wrapper
@@ -0,0 +1,17 @@
+import time
+import uuid
+
+
+class ActivationContext:
+    """
+    Stand-in for the DO Functions activation context, for running the handlers outside of the platform. Without a
+    deadline the remaining time is reported as -1
+    """
+    def __init__(self, activation_id: str | None = None, deadline_ms: int | None = None):
+        self.activation_id = activation_id or uuid.uuid4().hex
+        self.deadline = time.monotonic() + deadline_ms / 1000 if deadline_ms is not None else None
+
+    def get_remaining_time_in_millis(self) -> int:
+        if self.deadline is None:
+            return -1
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
@@ -1,8 +1,12 @@
 import os
+import hmac
 import logging
+from utils.warmup import warm_up
+from utils.metrics import render_metrics, METRICS_CONTENT_TYPE
 
 
 GET_RESULT_CONTENT_TYPE = {'Content-Type': 'text/plain'}
+JSON_CONTENT_TYPE = {'Content-Type': 'application/json'}
 EMPTY_200_RESPONSE = {"body": "", "statusCode": 200, "headers": GET_RESULT_CONTENT_TYPE}
 logger = logging.getLogger(__name__)
 
@@ -20,15 +24,61 @@ def confirm_webhook_subscription(event: dict, ctx) -> dict:
         return {"body": event.get('hub.challenge', ''), "statusCode": 200, "headers": GET_RESULT_CONTENT_TYPE}
 
 
+def is_authorized(event: dict, token_name: str) -> bool:
+    """
+    Check the `token` parameter or the bearer token of a request against the token in an env var. Without the env
+    var every request is refused, since these endpoints are reachable on the public web action
+    """
+    token = os.environ.get(token_name)
+    if not token:
+        return False
+    authorization = event.get('http', {}).get('headers', {}).get('authorization', '')
+    candidates = (str(event.get('token', '')), authorization.removeprefix('Bearer '))
+    return any(hmac.compare_digest(candidate.encode('utf-8'), token.encode('utf-8')) for candidate in candidates)
+
+
+def serve_metrics(event: dict, ctx) -> dict:
+    """
+    Reply with the metrics aggregated across every activation, guarded by METRICS_TOKEN
+    """
+    if not is_authorized(event, "METRICS_TOKEN"):
+        return {"body": "Metrics token mismatch", "statusCode": 403, "headers": GET_RESULT_CONTENT_TYPE}
+    try:
+        return {"body": render_metrics(), "statusCode": 200, "headers": METRICS_CONTENT_TYPE}
+    except Exception as e:
+        logger.error(f"ActvID {ctx.activation_id} Error rendering metrics: {e}", exc_info=True, stack_info=True)
+        return {"body": "Metrics unavailable", "statusCode": 503, "headers": GET_RESULT_CONTENT_TYPE}
+
+
+def reply_alive(event: dict, ctx) -> dict:
+    """
+    Reply to a healthcheck, warming up the process first when it asks for it with `warmup`, guarded by WARMUP_TOKEN
+    """
+    if str(event.get('warmup', '')).lower() not in ('1', 'true'):
+        return {"body": "I'm alive", "statusCode": 200, "headers": GET_RESULT_CONTENT_TYPE}
+    if not is_authorized(event, "WARMUP_TOKEN"):
+        return {"body": "Warm-up token mismatch", "statusCode": 403, "headers": GET_RESULT_CONTENT_TYPE}
+    try:
+        budget_ms = int(event.get('budget_ms', 0))
+    except (TypeError, ValueError):
+        logger.warning(f"ActvID {ctx.activation_id} Ignoring invalid warm-up budget {event.get('budget_ms')!r}")
+        budget_ms = 0
+    # Anything but a positive budget falls back to WARMUP_BUDGET_MS
+    results = warm_up(ctx, budget_ms=budget_ms if budget_ms > 0 else None)
+    return {"body": {"status": "I'm alive", "warmup": results}, "statusCode": 200, "headers": JSON_CONTENT_TYPE}
+
+
 def healthcheck_routing(event: dict, ctx) -> dict:
     logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Routing healthcheck request with {event=}")
     if event.get('healthcheck', False):
-        return {"body": "I'm alive", "statusCode": 200, "headers": GET_RESULT_CONTENT_TYPE}
+        return reply_alive(event, ctx)
     elif 'http' not in event:
         return {"body": "Invalid request", "statusCode": 400, "headers": GET_RESULT_CONTENT_TYPE}
     elif event['http']['method'] == 'GET':
         if event['http']['path'] == '/healthcheck':
-            return {"body": "I'm alive", "statusCode": 200, "headers": GET_RESULT_CONTENT_TYPE}
+            return reply_alive(event, ctx)
+        elif event['http']['path'] == '/metrics':
+            return serve_metrics(event, ctx)
         return confirm_webhook_subscription(event, ctx)
     else:
         return EMPTY_200_RESPONSE
@@ -5,6 +5,11 @@ from collections import namedtuple
 
 
 logger = logging.getLogger(__name__)
+JPEG_BYTE_BUDGET = 1024 * 1024
+PHOTO_MAX_DIMENSION = 4096
+TEXT_MAX_DIMENSION = 4096
+PHOTO_QUALITY_RANGE = (40, 75)
+TEXT_QUALITY_RANGE = (60, 95)
 
 
 class CaptionParsingError(Exception):
@@ -61,11 +66,113 @@ def convert_color_name_to_rgb(color_name: str):
     return colors.get(color_name, (255, 255, 255))
 
 
+def _save_jpeg(
+    image: Image.Image, quality: int, subsampling: int, final: bool = True
+) -> BytesIO:
+    jpeg_buffer = BytesIO()
+    # Optimized encoding is slower and only ever smaller, so it's skipped
+    # while searching and used for the final encode
+    image.save(
+        jpeg_buffer,
+        "JPEG",
+        quality=quality,
+        subsampling=subsampling,
+        optimize=final,
+    )
+    return jpeg_buffer
+
+
+def _search_jpeg_quality(
+    image: Image.Image, max_bytes: int, subsampling: int, quality_range: tuple[int, int]
+) -> tuple[int | None, int]:
+    """
+    Binary search the highest quality in the range whose encoding fits the byte
+    budget. Returns that quality, or None if not even the lowest quality fits,
+    along with the size of the smallest encoding tried
+    """
+    low, high = quality_range
+    smallest = _save_jpeg(image, low, subsampling, final=False).getbuffer().nbytes
+    if smallest > max_bytes:
+        return None, smallest
+    best = low
+    low += 1
+    # Try the top of the range first, since most images fit at once
+    quality = high
+    while low <= high:
+        if _save_jpeg(image, quality, subsampling, final=False).getbuffer().nbytes <= max_bytes:
+            best = quality
+            low = quality + 1
+        else:
+            high = quality - 1
+        quality = (low + high + 1) // 2
+    return best, smallest
+
+
+def encode_jpeg(
+    image: Image.Image,
+    max_bytes: int = JPEG_BYTE_BUDGET,
+    text_friendly: bool = False,
+) -> BytesIO:
+    """
+    Encode an image as an optimized JPEG that fits the byte budget. Most images
+    fit at the top of the quality range, so they're encoded once; for the rest
+    the image is capped to the maximum dimension, the best quality and chroma
+    subsampling that fit are searched for, and if none do the image is
+    downscaled until it fits. Text-friendly encoding (for ASCII art) keeps
+    full chroma resolution and higher qualities for as long as possible, since
+    subsampling smears the edges of thin glyphs
+    """
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    max_dimension = TEXT_MAX_DIMENSION if text_friendly else PHOTO_MAX_DIMENSION
+    quality_range = TEXT_QUALITY_RANGE if text_friendly else PHOTO_QUALITY_RANGE
+    # Pillow subsampling values: 0 is 4:4:4, 2 is 4:2:0
+    subsamplings = (0, 2) if text_friendly else (2,)
+    if max(image.size) <= max_dimension:
+        jpeg_buffer = _save_jpeg(image, quality_range[1], subsamplings[0])
+        if jpeg_buffer.getbuffer().nbytes <= max_bytes:
+            jpeg_buffer.seek(0)
+            return jpeg_buffer
+    scale = min(1.0, max_dimension / max(image.size))
+    while True:
+        if scale < 1.0:
+            image = image.resize(
+                (max(1, int(image.width * scale)), max(1, int(image.height * scale))),
+                Image.Resampling.LANCZOS,
+            )
+        for subsampling in subsamplings:
+            quality, smallest = _search_jpeg_quality(
+                image, max_bytes, subsampling, quality_range
+            )
+            if quality is not None:
+                jpeg_buffer = _save_jpeg(image, quality, subsampling)
+                jpeg_buffer.seek(0)
+                return jpeg_buffer
+        if min(image.size) <= 64:
+            jpeg_buffer = _save_jpeg(image, quality_range[0], subsamplings[-1])
+            jpeg_buffer.seek(0)
+            return jpeg_buffer
+        # The encoded size is roughly proportional to the pixel count
+        scale = min(0.9, (max_bytes / smallest) ** 0.5 * 0.95)
+
+
+def shrink_jpeg(
+    image_buffer: BytesIO, max_bytes: int, text_friendly: bool = False
+) -> BytesIO:
+    """
+    Re-encode an image so that it fits the byte budget
+    """
+    return encode_jpeg(
+        Image.open(image_buffer), max_bytes=max_bytes, text_friendly=text_friendly
+    )
+
+
 def convert_png_to_jpeg(
     image_buffer: BytesIO,
     background_color_name: str,
     background_color_rgb: tuple[int, int, int] = (255, 255, 255),
     ctx=None,
+    text_friendly: bool = False,
 ) -> tuple[BytesIO, str]:
     logger.debug(
         f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Comverting PNG image to JPEG"
@@ -132,17 +239,12 @@ def convert_png_to_jpeg(
                 f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Image converted"
             )
 
-    jpeg_buffer = BytesIO()
-    logger.debug(
-        f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Saving the image as a JPEG"
-    )
-    image.save(jpeg_buffer, "JPEG")
     logger.debug(
-        f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Rewinding the JPEG image buffer"
+        f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Encoding the image as a JPEG within {JPEG_BYTE_BUDGET} bytes"
     )
-    jpeg_buffer.seek(0)
+    jpeg_buffer = encode_jpeg(image, text_friendly=text_friendly)
     logger.debug(
-        f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Returning the JPEG image buffer"
+        f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Returning the JPEG image buffer of {jpeg_buffer.getbuffer().nbytes} bytes"
     )
     return jpeg_buffer, "image/jpeg"
 
@@ -0,0 +1,100 @@
+import os
+import time
+import asyncio
+import logging
+from collections import namedtuple
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
+from utils.aio import call, call_in
+from utils.metrics import observe
+
+
+logger = logging.getLogger(__name__)
+
+
+Lane = namedtuple("Lane", ["name", "concurrency"])
+
+
+# Messages are served from the lane of their expected cost, so cheap ones never wait for a slot behind heavy ones
+LANES = {
+    'command': Lane(name="command", concurrency=int(os.getenv('LANE_COMMAND_CONCURRENCY') or 8)),
+    'tts': Lane(name="text to speech", concurrency=int(os.getenv('LANE_TTS_CONCURRENCY') or 4)),
+    'audio': Lane(name="transcription", concurrency=int(os.getenv('LANE_AUDIO_CONCURRENCY') or 2)),
+    'image': Lane(name="image operation", concurrency=int(os.getenv('LANE_IMAGE_CONCURRENCY') or 2)),
+}
+TTS_COMMANDS = ('get_voices', 'set_voice', 'get_voice')
+# Every lane has its own threads, shared by every request of the process, so its limit holds across concurrent
+# requests and the heavy lanes can never take the threads of the commands
+_lane_executors = {lane: ThreadPoolExecutor(max_workers=spec.concurrency, thread_name_prefix=f'lane-{lane}') for lane, spec in LANES.items()}
+_lane: ContextVar[str | None] = ContextVar('lane', default=None)
+
+
+def classify_message(message: dict) -> str:
+    """
+    Get the lane of a message by its expected cost: replies from Redis or cached data, text to speech, audio
+    transcription, or image operations
+    """
+    if message['type'] == 'text':
+        words = message['text']['body'].split(' ')
+        if words[0] == '/tts' and (len(words) < 2 or words[1] not in TTS_COMMANDS):
+            return 'tts'
+        return 'command'
+    elif message['type'] in ('audio', 'image'):
+        return message['type']
+    return 'command'
+
+
+async def call_in_lane(func, *args, **kwargs):
+    """
+    Run the blocking processing of a message in a thread of its lane, waiting for one to be free. Outside of a lane
+    it runs like any other call
+    """
+    lane = _lane.get()
+    if lane is None:
+        return await call(func, *args, **kwargs)
+    submitted_at = time.perf_counter()
+
+    def run():
+        observe('lane_wait_ms', (time.perf_counter() - submitted_at) * 1000, lane=lane)
+        return func(*args, **kwargs)
+
+    return await call_in(_lane_executors[lane], run)
+
+
+class LaneScheduler:
+    """
+    Run the messages of a request concurrently, each processed in the threads of its lane, while the messages of a
+    single sender still run one after the other in arrival order, so their replies keep that order
+    """
+    def __init__(self):
+        self.tasks: list[asyncio.Task] = []
+        self.last_task_by_sender: dict[str, asyncio.Task] = {}
+
+    def submit(self, sender: str, lane: str, coroutine_function, *args) -> asyncio.Task:
+        """
+        Schedule `coroutine_function(*args)` in a lane, after every message submitted before by the same sender. Its
+        calls through `call_in_lane` run in the threads of the lane
+        """
+        previous = self.last_task_by_sender.get(sender)
+
+        async def run():
+            if previous is not None:
+                # Only the order matters here, the failure of the previous message is reported by its own task
+                await asyncio.gather(previous, return_exceptions=True)
+            # The task runs in a copy of the context, so the lane is only set for this message
+            _lane.set(lane)
+            return await coroutine_function(*args)
+
+        task = asyncio.create_task(run())
+        self.tasks.append(task)
+        self.last_task_by_sender[sender] = task
+        return task
+
+    async def join(self) -> None:
+        """
+        Wait for every message submitted so far, logging those that failed
+        """
+        tasks, self.tasks = self.tasks, []
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to process a message: {result}", exc_info=result)
@@ -4,7 +4,9 @@ import redis
 import socket
 import logging
 import logging.config
+from functools import lru_cache
 from logging.handlers import SysLogHandler
+from utils.metrics import increment
 
 
 class ContextFilter(logging.Filter):
@@ -14,7 +16,18 @@ class ContextFilter(logging.Filter):
         return True
     
 
+_logging_initialized = False
+
+
 def init_logging():
+    """
+    Send the logs to the syslog server. Only the first call in a process sets it up, so warm containers and
+    long-running servers don't stack a new handler on every request
+    """
+    global _logging_initialized
+    if _logging_initialized:
+        return
+    _logging_initialized = True
     syslogaddress = (os.getenv('SYSLOG_HOST'), int(os.getenv('SYSLOG_PORT')))
     syslog = SysLogHandler(address=syslogaddress, facility=SysLogHandler.LOG_USER)
     syslog.setFormatter(logging.Formatter("%(levelname)s %(name)s %(message)s"))
@@ -23,27 +36,112 @@ def init_logging():
     logger.setLevel(logging.INFO)
 
 
-def log_to_redis(key: str, value: str, value_is_sender: bool = True):
-    r = redis.Redis(
+def _count_redis_command(name) -> None:
+    name = name.decode('utf-8') if isinstance(name, bytes) else str(name)
+    # Multi-word commands like `CLIENT SETNAME` come as a single argument
+    increment('redis_commands_total', command=name.split(' ')[0].lower())
+
+
+class InstrumentedSSLConnection(redis.SSLConnection):
+    """
+    Redis connection that counts every command it sends, pipelined or not, for the metrics endpoint
+    """
+    # Single commands are packed by `send_command` itself, without going through `pack_command`
+    def send_command(self, *args, **kwargs):
+        _count_redis_command(args[0])
+        return super().send_command(*args, **kwargs)
+
+    def pack_commands(self, commands):
+        for args in commands:
+            _count_redis_command(args[0])
+        return super().pack_commands(commands)
+
+
+@lru_cache(maxsize=1)
+def get_redis_client() -> redis.Redis:
+    """
+    Get a Redis client shared by every caller in the current process, so warm activations reuse its connection pool
+    """
+    return redis.Redis(connection_pool=redis.ConnectionPool(
+        connection_class=InstrumentedSSLConnection,
         host=os.getenv('REDIS_HOST'),
         port=os.getenv('REDIS_PORT'),
-        password=os.getenv('REDIS_PASSWORD'),
-        ssl=True
-    )
+        password=os.getenv('REDIS_PASSWORD')
+    ))
+
+
+AUDIT_RETENTION_DAYS = int(os.getenv('AUDIT_RETENTION_DAYS') or 30)
+AUDIT_BUCKET_SECONDS = 24 * 60 * 60
+
+
+def get_audit_bucket_key(timestamp: int) -> str:
+    """
+    Get the key of the daily hash that holds the audit records written at the given timestamp
+    """
+    return f"audit:{time.strftime('%Y-%m-%d', time.gmtime(timestamp))}"
+
+
+def get_audit_bucket_expiry(timestamp: int) -> int:
+    """
+    Get the unix time at which the daily hash holding the given timestamp leaves the retention window
+    """
+    return timestamp - timestamp % AUDIT_BUCKET_SECONDS + (AUDIT_RETENTION_DAYS + 1) * AUDIT_BUCKET_SECONDS
+
+
+def log_to_redis(key: str, value: str, value_is_sender: bool = True, timestamp: int | None = None):
+    """
+    Record who an activation or media ID belongs to as a field of the expiring daily audit hash
+    """
+    r = get_redis_client()
     if value_is_sender:
         value = value if value.startswith('+') else f'+{value}'
-    r.set(key, value)
-    r.set(f'{key}-timestamp', int(time.time()))
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    bucket_key = get_audit_bucket_key(timestamp)
+    pipe = r.pipeline(transaction=False)
+    pipe.hset(bucket_key, key, f'{value}|{timestamp}')
+    pipe.expireat(bucket_key, get_audit_bucket_expiry(timestamp))
+    pipe.execute()
 
 
-def read_from_redis(key: str) -> str | None:
-    r = redis.Redis(
-        host=os.getenv('REDIS_HOST'),
-        port=os.getenv('REDIS_PORT'),
-        password=os.getenv('REDIS_PASSWORD'),
-        ssl=True
-    )
-    data = r.get(key)
-    if data:
-        return data.decode('utf-8')
-    return None
\ No newline at end of file
+def migrate_legacy_audit_records(batch_size: int = 500) -> tuple[int, int]:
+    """
+    Fold the old `<key>` + `<key>-timestamp` audit pairs into the daily audit hashes, dropping the ones already
+    past the retention window, and delete the old keys. Returns how many records were migrated and expired
+    """
+    r = get_redis_client()
+    cutoff = int(time.time()) - AUDIT_RETENTION_DAYS * AUDIT_BUCKET_SECONDS
+    migrated, expired = 0, 0
+    batch = []
+
+    def flush():
+        nonlocal migrated, expired
+        read_pipe = r.pipeline(transaction=False)
+        for key in batch:
+            read_pipe.get(key)
+            read_pipe.get(f'{key}-timestamp')
+        values = read_pipe.execute()
+        write_pipe = r.pipeline(transaction=False)
+        for key, value, timestamp in zip(batch, values[::2], values[1::2]):
+            timestamp = int(timestamp) if timestamp else 0
+            if value and timestamp >= cutoff:
+                bucket_key = get_audit_bucket_key(timestamp)
+                write_pipe.hset(bucket_key, key, f"{value.decode('utf-8')}|{timestamp}")
+                write_pipe.expireat(bucket_key, get_audit_bucket_expiry(timestamp))
+                migrated += 1
+            else:
+                expired += 1
+            write_pipe.delete(key, f'{key}-timestamp')
+        write_pipe.execute()
+        batch.clear()
+
+    for timestamp_key in r.scan_iter(match='*-timestamp', count=batch_size):
+        key = timestamp_key.decode('utf-8').removesuffix('-timestamp')
+        if '|' in key:
+            # Legacy preference keys are migrated by utils.preferences
+            continue
+        batch.append(key)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return migrated, expired
@@ -1,11 +1,35 @@
 import os
+import time
 import boto3
 import logging
-import requests
+import hashlib
+import threading
 from io import BytesIO
+from functools import lru_cache
+from contextvars import ContextVar
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from botocore.exceptions import ClientError
+from utils.image import shrink_jpeg
+from utils.aio import coalesced, defer
+from utils.logging import get_redis_client
+from utils.metrics import increment
+from utils.services import call_service
 
 
 logger = logging.getLogger(__name__)
+META_MAX_IMAGE_BYTES = 5 * 1024 * 1024
+META_MEDIA_ID_TTL_DAYS = float(os.getenv('META_MEDIA_ID_TTL_DAYS') or 25)  # Meta keeps uploaded media for 30 days
+STORAGE_RETENTION_DAYS = float(os.getenv('STORAGE_RETENTION_DAYS') or 30)
+SPACES_DELETE_BATCH_SIZE = 1000  # Max keys accepted by a single DeleteObjects request
+# How long a backup counts as fresh after it was written or refreshed, and how many of them this process remembers
+STORED_FILE_MEMO_SECONDS = 24 * 60 * 60
+STORED_FILE_MEMO_SIZE = 10000
+_stored_file_keys: OrderedDict[str, float] = OrderedDict()
+_stored_file_keys_lock = threading.Lock()
+_intermediate_files: ContextVar[list[str] | None] = ContextVar('intermediate_files', default=None)
 
 
 class MediaProcessingError(Exception):
@@ -37,6 +61,7 @@ def get_media_extension(mime_type: str) -> str:
     return mime_type.split('/')[-1]
 
 
+@coalesced
 def get_media_metadata(media_id: str) -> tuple[str, str, str, str]:
     """
     Get the metadata of a media file from the Meta Graph API
@@ -45,15 +70,16 @@ def get_media_metadata(media_id: str) -> tuple[str, str, str, str]:
     headers = {
         'Authorization': f'Bearer {os.environ.get("GRAPH_API_TOKEN")}'
     }
-    response = requests.get(url, headers=headers)
+    response = call_service('graph', 'GET', url, hedge=True, headers=headers)
     response.raise_for_status()
     response_json = response.json()
     return response_json['url'], response_json['sha256'], response_json['mime_type'], response_json['file_size']
 
 
-def get_media_file_from_spaces(file_key: str, delete: bool = False) -> BytesIO:
+@lru_cache(maxsize=1)
+def get_spaces_client():
     """
-    Get the media file from DigitalOcean Spaces
+    Get a DigitalOcean Spaces client shared by every caller in the current process
     """
     session = boto3.session.Session()
     client = session.client(
@@ -63,6 +89,19 @@ def get_media_file_from_spaces(file_key: str, delete: bool = False) -> BytesIO:
         aws_access_key_id=os.getenv('STORAGE_KEY'),
         aws_secret_access_key=os.getenv('STORAGE_SECRET')
     )
+    client.meta.events.register('after-call.s3', _count_spaces_operation)
+    return client
+
+
+def _count_spaces_operation(model, **kwargs):
+    increment('spaces_operations_total', operation=model.name)
+
+
+def get_media_file_from_spaces(file_key: str, delete: bool = False) -> BytesIO:
+    """
+    Get the media file from DigitalOcean Spaces
+    """
+    client = get_spaces_client()
     logger.debug(f"Getting media file {file_key=} from {os.getenv('STORAGE_NAME')=}")
     response = client.get_object(
         Bucket=os.getenv('STORAGE_NAME'),
@@ -80,72 +119,273 @@ def get_media_file_from_spaces(file_key: str, delete: bool = False) -> BytesIO:
     return BytesIO(response['Body'].read())
 
 
-def post_media_file_to_spaces(media_id: str, media_buffer: BytesIO, mime_type: str) -> str:
+def get_media_file_key(file_hash: str, mime_type: str) -> str:
     """
-    Upload the media file to DigitalOcean Spaces
+    Get the content-addressed key under which a media file is backed up in DigitalOcean Spaces
+    """
+    return f'media/{file_hash}.{get_media_extension(mime_type)}'
+
+
+def _remember_stored_file(file_key: str) -> None:
+    with _stored_file_keys_lock:
+        _stored_file_keys[file_key] = time.monotonic() + STORED_FILE_MEMO_SECONDS
+        _stored_file_keys.move_to_end(file_key)
+        while len(_stored_file_keys) > STORED_FILE_MEMO_SIZE:
+            _stored_file_keys.popitem(last=False)
+
+
+def _is_recently_stored_file(file_key: str) -> bool:
+    with _stored_file_keys_lock:
+        fresh_until = _stored_file_keys.get(file_key)
+        if fresh_until is None:
+            return False
+        if fresh_until < time.monotonic():
+            del _stored_file_keys[file_key]
+            return False
+        return True
+
+
+def refresh_media_file_in_spaces(file_key: str, mime_type: str) -> bool:
+    """
+    Copy a file in DigitalOcean Spaces onto itself, so its last modified date restarts the retention period the
+    sweeper goes by. Returns whether the file exists
     """
     try:
-        session = boto3.session.Session()
-        client = session.client(
-            's3',
-            region_name=os.getenv('STORAGE_REGION'),
-            endpoint_url=os.getenv('STORAGE_ENDPOINT'),
-            aws_access_key_id=os.getenv('STORAGE_KEY'),
-            aws_secret_access_key=os.getenv('STORAGE_SECRET')
-        )
-        logger.debug(f"Backing up media file {media_id=} to {os.getenv('STORAGE_NAME')=} with {mime_type=}")
-        client.put_object(
+        get_spaces_client().copy_object(
             Bucket=os.getenv('STORAGE_NAME'),
-            Key=f'{media_id}.{get_media_extension(mime_type)}',
-            Body=media_buffer,
+            Key=file_key,
+            CopySource={'Bucket': os.getenv('STORAGE_NAME'), 'Key': file_key},
+            MetadataDirective='REPLACE',
             ContentType=mime_type,
             ACL='private'
         )
-    except Exception as e:
-        logger.error(f"Error backing up media file: {e}", exc_info=True, stack_info=True)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return True
 
 
-def delete_media_file_from_spaces(file_key: str) -> None:
+def put_media_file_to_spaces(file_key: str, media_buffer: BytesIO, mime_type: str) -> None:
     """
-    Delete the media file from DigitalOcean Spaces
+    Upload a file to DigitalOcean Spaces under the given key
     """
-    session = boto3.session.Session()
-    client = session.client(
-        's3',
-        region_name=os.getenv('STORAGE_REGION'),
-        endpoint_url=os.getenv('STORAGE_ENDPOINT'),
-        aws_access_key_id=os.getenv('STORAGE_KEY'),
-        aws_secret_access_key=os.getenv('STORAGE_SECRET')
-    )
-    logger.debug(f"Deleting media file {file_key=} from {os.getenv('STORAGE_NAME')=}")
-    client.delete_object(
+    client = get_spaces_client()
+    logger.debug(f"Uploading media file {file_key=} to {os.getenv('STORAGE_NAME')=} with {mime_type=}")
+    client.put_object(
         Bucket=os.getenv('STORAGE_NAME'),
-        Key=file_key
+        Key=file_key,
+        Body=media_buffer,
+        ContentType=mime_type,
+        ACL='private'
     )
-    logger.debug(f"Deleted media file {file_key=} from {os.getenv('STORAGE_NAME')=}")
 
 
-def get_media_file_from_meta(file_url: str, media_id: str) -> BytesIO:
+def backup_media_file_to_spaces(media_buffer: BytesIO, mime_type: str, file_hash: str | None = None) -> str | None:
+    """
+    Back up the media file to DigitalOcean Spaces under the hash of its content, skipping the upload if the same
+    content is already stored. An existing backup is refreshed instead, at most once a day per process, so the
+    sweeper only deletes content nobody sent within the retention period. Returns the key of the backup
+    """
+    try:
+        if file_hash is None:
+            file_hash = hashlib.sha256(media_buffer.getbuffer()).hexdigest()
+        file_key = get_media_file_key(file_hash, mime_type)
+        if _is_recently_stored_file(file_key):
+            increment('cache_requests_total', cache='spaces_stored_keys', result='hit')
+            increment('media_backups_total', result='deduplicated')
+            logger.debug(f"Media file already backed up as {file_key=} in {os.getenv('STORAGE_NAME')=}")
+            return file_key
+        increment('cache_requests_total', cache='spaces_stored_keys', result='miss')
+        if refresh_media_file_in_spaces(file_key, mime_type):
+            increment('media_backups_total', result='refreshed')
+            logger.debug(f"Media file already backed up as {file_key=} in {os.getenv('STORAGE_NAME')=}, refreshed it")
+        else:
+            logger.debug(f"Backing up media file as {file_key=} to {os.getenv('STORAGE_NAME')=} with {mime_type=}")
+            put_media_file_to_spaces(file_key, media_buffer, mime_type)
+            increment('media_backups_total', result='uploaded')
+        _remember_stored_file(file_key)
+        return file_key
+    except Exception as e:
+        logger.error(f"Error backing up media file: {e}", exc_info=True, stack_info=True)
+        return None
+
+
+def index_media_file(media_id: str, file_key: str) -> None:
+    """
+    Record the key of the backup of a media file under its Meta media ID
+    """
+    try:
+        get_redis_client().set(f'media:{media_id}', file_key, ex=int(STORAGE_RETENTION_DAYS * 24 * 60 * 60))
+    except Exception as e:
+        logger.error(f"Error indexing media file {media_id=}: {e}", exc_info=True, stack_info=True)
+
+
+def post_media_file_to_spaces(media_id: str, media_buffer: BytesIO, mime_type: str, file_hash: str | None = None) -> str | None:
+    """
+    Back up the media file to DigitalOcean Spaces and index its media ID to the backup. Returns the key of the backup
+    """
+    file_key = backup_media_file_to_spaces(media_buffer, mime_type, file_hash)
+    if file_key is not None:
+        index_media_file(media_id, file_key)
+    return file_key
+
+
+def delete_media_files_from_spaces(file_keys: Iterable[str]) -> int:
+    """
+    Delete many media files from DigitalOcean Spaces using as few multi-object delete requests as possible.
+    Returns how many files were deleted
+    """
+    client = get_spaces_client()
+    deleted = 0
+    batch = []
+
+    def flush():
+        nonlocal deleted
+        response = client.delete_objects(
+            Bucket=os.getenv('STORAGE_NAME'),
+            Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+        )
+        errors = response.get('Errors', [])
+        for error in errors:
+            logger.error(f"Error deleting media file {error.get('Key')=} from {os.getenv('STORAGE_NAME')=}: {error.get('Code')} {error.get('Message')}")
+        deleted += len(batch) - len(errors)
+        batch.clear()
+
+    for file_key in file_keys:
+        batch.append(file_key)
+        if len(batch) >= SPACES_DELETE_BATCH_SIZE:
+            flush()
+    if batch:
+        flush()
+    logger.debug(f"Deleted {deleted} media files from {os.getenv('STORAGE_NAME')=}")
+    return deleted
+
+
+def list_media_files_from_spaces(prefix: str = '', older_than: timedelta | None = None) -> Iterator[str]:
+    """
+    List the keys of the media files in DigitalOcean Spaces under a prefix, optionally only those last modified
+    longer ago than the given age
+    """
+    paginator = get_spaces_client().get_paginator('list_objects_v2')
+    cutoff = datetime.now(timezone.utc) - older_than if older_than is not None else None
+    for page in paginator.paginate(Bucket=os.getenv('STORAGE_NAME'), Prefix=prefix):
+        for item in page.get('Contents', []):
+            if cutoff is None or item['LastModified'] < cutoff:
+                yield item['Key']
+
+
+def sweep_media_files_from_spaces(older_than: timedelta, prefix: str = '', dry_run: bool = False) -> int:
+    """
+    Delete every media file under a prefix older than the retention period. Returns how many files were (or,
+    on a dry run, would have been) deleted
+    """
+    logger.info(f"Sweeping media files under {prefix=} older than {older_than} from {os.getenv('STORAGE_NAME')=}")
+    file_keys = list_media_files_from_spaces(prefix=prefix, older_than=older_than)
+    if dry_run:
+        return sum(1 for _ in file_keys)
+    return delete_media_files_from_spaces(file_keys)
+
+
+@contextmanager
+def intermediate_files():
+    """
+    Track the intermediate files written to DigitalOcean Spaces while handling a request, and delete them all
+    when the request is done, whether it succeeded or not
+    """
+    file_keys = []
+    token = _intermediate_files.set(file_keys)
+    try:
+        yield file_keys
+    finally:
+        _intermediate_files.reset(token)
+        if file_keys:
+            try:
+                delete_media_files_from_spaces(file_keys)
+            except Exception as e:
+                logger.error(f"Error deleting intermediate media files {file_keys=}: {e}", exc_info=True, stack_info=True)
+
+
+def track_intermediate_file(file_key: str) -> None:
+    """
+    Mark a file in DigitalOcean Spaces for deletion at the end of the current request
+    """
+    file_keys = _intermediate_files.get()
+    if file_keys is None:
+        logger.warning(f"Intermediate media file {file_key=} created outside of a tracked request, it will be left to the sweeper")
+        return
+    file_keys.append(file_key)
+
+
+def get_media_file_from_meta(file_url: str, media_id: str, file_hash: str | None = None) -> BytesIO:
     """
     Get the media file from the Meta Graph API
     """
     headers = {
         'Authorization': f'Bearer {os.environ.get("GRAPH_API_TOKEN")}'
     }
-    file_response = requests.get(file_url, headers=headers)
+    file_response = call_service('graph', 'GET', file_url, read_timeout=20, headers=headers)
     file_response.raise_for_status()
     try:
-        post_media_file_to_spaces(media_id, BytesIO(file_response.content), file_response.headers['Content-Type'])
+        hashed_file = hashlib.sha256(file_response.content).hexdigest()
+        if file_hash is not None and hashed_file != file_hash:
+            logger.warning(f"Not backing up media file {media_id=}, its hash {hashed_file} doesn't match the expected {file_hash}")
+        else:
+            defer(post_media_file_to_spaces, media_id, BytesIO(file_response.content), file_response.headers['Content-Type'], file_hash=hashed_file)
     except Exception as e:
         logger.error(f"Error backing up media file: {e}", exc_info=True, stack_info=True)
     return BytesIO(file_response.content)
 
 
-def post_media_file_to_meta(phone_number_id: str, media_buffer: BytesIO, mime_type: str) -> str:
+def get_meta_media_id_key(phone_number_id: str, file_hash: str) -> str:
+    """
+    Get the Redis key that caches the Meta media ID of content already uploaded from a phone number
+    """
+    return f'meta-media:{phone_number_id}:{file_hash}'
+
+
+def get_cached_meta_media_id(phone_number_id: str, file_hash: str) -> str | None:
+    """
+    Get the Meta media ID of content already uploaded from a phone number, if it hasn't expired yet
+    """
+    try:
+        media_id = get_redis_client().get(get_meta_media_id_key(phone_number_id, file_hash))
+    except Exception as e:
+        logger.error(f"Error reading cached Meta media ID: {e}", exc_info=True, stack_info=True)
+        return None
+    increment('cache_requests_total', cache='meta_media_ids', result='hit' if media_id else 'miss')
+    return media_id.decode('utf-8') if media_id else None
+
+
+def cache_meta_media_id(phone_number_id: str, file_hash: str, media_id: str) -> None:
+    """
+    Remember the Meta media ID of uploaded content until shortly before Meta expires it
+    """
+    try:
+        get_redis_client().set(get_meta_media_id_key(phone_number_id, file_hash), media_id, ex=int(META_MEDIA_ID_TTL_DAYS * 24 * 60 * 60))
+    except Exception as e:
+        logger.error(f"Error caching Meta media ID {media_id=}: {e}", exc_info=True, stack_info=True)
+
+
+def forget_meta_media_id(phone_number_id: str, file_hash: str) -> None:
+    """
+    Drop a cached Meta media ID that Meta no longer accepts
+    """
+    try:
+        get_redis_client().delete(get_meta_media_id_key(phone_number_id, file_hash))
+    except Exception as e:
+        logger.error(f"Error forgetting cached Meta media ID: {e}", exc_info=True, stack_info=True)
+
+
+def post_media_file_to_meta(phone_number_id: str, media_buffer: BytesIO, mime_type: str, file_hash: str | None = None) -> str:
     """
     Post the media file to the Meta Graph API and get the posted media ID
     """
-    if media_buffer.getbuffer().nbytes > 5 * 1024 * 1024:
+    if mime_type.startswith('image/') and media_buffer.getbuffer().nbytes > META_MAX_IMAGE_BYTES:
+        logger.debug(f"Shrinking image of {media_buffer.getbuffer().nbytes/1024} KB to fit within {META_MAX_IMAGE_BYTES/1024} KB")
+        media_buffer, mime_type = shrink_jpeg(media_buffer, max_bytes=META_MAX_IMAGE_BYTES), 'image/jpeg'
+        file_hash = None
+    if media_buffer.getbuffer().nbytes > META_MAX_IMAGE_BYTES:
         raise MediaProcessingError("El archivo excede el tamaño máximo de 5 MB. Por favor intenta con un texto más corto, o con menores dimensiones de arte ASCII.")
     url = f'https://graph.facebook.com/v21.0/{phone_number_id}/media'
     headers = {
@@ -158,11 +398,9 @@ def post_media_file_to_meta(phone_number_id: str, media_buffer: BytesIO, mime_ty
         'messaging_product': (None, 'whatsapp')
     }
     logger.debug(f"Posting media file to {url=}, {files=}, file size {media_buffer.getbuffer().nbytes/1024} KB")
-    response = requests.request("POST", url, headers=headers, files=files)
+    response = call_service('graph', 'POST', url, headers=headers, files=files)
     response.raise_for_status()
-    try:
-        assert media_buffer.seek(0) == 0, "Media buffer couldn't be rewinded"
-        post_media_file_to_spaces(response.json()['id'], media_buffer, mime_type)
-    except Exception as e:
-        logger.error(f"Error backing up media file: {e}", exc_info=True, stack_info=True)
-    return response.json()['id']
+    media_id = response.json()['id']
+    # The backup runs alongside the send on its own copy of the buffer, and is only indexed if it was written
+    defer(post_media_file_to_spaces, media_id, BytesIO(media_buffer.getvalue()), mime_type, file_hash)
+    return media_id
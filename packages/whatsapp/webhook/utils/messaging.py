@@ -1,17 +1,30 @@
 import os
 import json
+import logging
+import hashlib
 import requests
 from io import BytesIO
+from utils.metrics import increment
 from utils.logging import log_to_redis
-from utils.media import post_media_file_to_meta
+from utils.services import call_service
+from utils.media import post_media_file_to_meta, get_cached_meta_media_id, cache_meta_media_id, forget_meta_media_id
+
+
+logger = logging.getLogger(__name__)
+# Graph API errors about the media itself: download and upload errors, and media IDs that expired or don't exist
+MEDIA_ERROR_CODES = (131052, 131053)
+GENERIC_PARAMETER_ERROR_CODES = (100, 131009)
 
 
 def mark_as_read(phone_number_id: str, message_id: str):
     """
     Mark a message as read
     """
-    response = requests.post(
+    response = call_service(
+        'graph',
+        'POST',
         f"https://graph.facebook.com/v19.0/{phone_number_id}/messages",
+        idempotent=True,
         headers={
             "Content-Type": "application/json",
             "Authorization": f'Bearer {os.environ.get("GRAPH_API_TOKEN")}'
@@ -46,17 +59,15 @@ def send_text(phone_number_id: str, sender: str, text: str, reply_to_id: str = N
     }
     if reply_to_id:
         payload['context'] = {'message_id': reply_to_id}
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
+    response = call_service('graph', 'POST', url, headers=headers, data=json.dumps(payload))
     response.raise_for_status()
 
 
-def send_media(phone_number_id: str, sender: str, mime_type: str, media_buffer: BytesIO, reply_to_id: str = None):
+def send_media_by_id(phone_number_id: str, sender: str, mime_type: str, media_id: str, reply_to_id: str = None) -> requests.Response:
     """
-    Send a media message
+    Send a media message with media already uploaded to Meta, returning the response without checking it
     """
     url = f"https://graph.facebook.com/v19.0/{phone_number_id}/messages"
-    media_id = post_media_file_to_meta(phone_number_id, media_buffer, mime_type)
-    log_to_redis(media_id, sender)
     media_type = mime_type.split('/')[0]
     payload = {
         "messaging_product": "whatsapp",
@@ -73,5 +84,54 @@ def send_media(phone_number_id: str, sender: str, mime_type: str, media_buffer:
     }
     if reply_to_id:
         payload['context'] = {'message_id': reply_to_id}
-    response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
+    return call_service('graph', 'POST', url, headers=headers, data=json.dumps(payload))
+
+
+def is_media_id_error(response: requests.Response) -> bool:
+    """
+    Check whether the Graph API rejected a message because of its media ID, rather than for any other reason like
+    the recipient or the messaging window
+    """
+    try:
+        error = response.json().get('error', {})
+    except ValueError:
+        return False
+    if error.get('code') in MEDIA_ERROR_CODES:
+        return True
+    if error.get('code') in GENERIC_PARAMETER_ERROR_CODES:
+        # These codes cover any invalid parameter, so only the details tell whether it was the media ID
+        details = f"{error.get('message', '')} {json.dumps(error.get('error_data', {}))}".lower()
+        return 'media' in details
+    return False
+
+
+def log_media_recipient(media_id: str, sender: str) -> None:
+    """
+    Record who received a media ID in the audit. The same media ID is sent to every sender asking for the same
+    content, so each recipient gets its own record
+    """
+    log_to_redis(f"{media_id}:{sender.lstrip('+')}", sender)
+
+
+def send_media(phone_number_id: str, sender: str, mime_type: str, media_buffer: BytesIO, reply_to_id: str = None):
+    """
+    Send a media message. Content already uploaded to Meta is sent by its media ID instead of being uploaded again
+    """
+    file_hash = hashlib.sha256(media_buffer.getbuffer()).hexdigest()
+    media_id = get_cached_meta_media_id(phone_number_id, file_hash)
+    if media_id is not None:
+        response = send_media_by_id(phone_number_id, sender, mime_type, media_id, reply_to_id)
+        if response.ok:
+            logger.debug(f"Sent media by cached {media_id=}")
+            log_media_recipient(media_id, sender)
+            return
+        if response.status_code not in (400, 404) or not is_media_id_error(response):
+            response.raise_for_status()
+        increment('cache_requests_total', cache='meta_media_ids', result='stale')
+        logger.info(f"Meta rejected cached {media_id=} with status {response.status_code}, uploading the media again")
+        forget_meta_media_id(phone_number_id, file_hash)
+    media_id = post_media_file_to_meta(phone_number_id, media_buffer, mime_type, file_hash=file_hash)
+    cache_meta_media_id(phone_number_id, file_hash, media_id)
+    response = send_media_by_id(phone_number_id, sender, mime_type, media_id, reply_to_id)
     response.raise_for_status()
+    log_media_recipient(media_id, sender)
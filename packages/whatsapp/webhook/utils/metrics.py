@@ -0,0 +1,122 @@
+import re
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+COUNTERS_KEY = 'metrics:counters'
+HISTOGRAMS_KEY = 'metrics:histograms'
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000)
+METRICS_CONTENT_TYPE = {'Content-Type': 'text/plain; version=0.0.4'}
+_lock = threading.Lock()
+_counters: dict[str, float] = {}
+_histograms: dict[str, float] = {}
+
+
+def _get_series(name: str, labels: dict) -> str:
+    # Label values can't contain the separators the series are stored with
+    pairs = [f"{key}={re.sub(r'[|,=]', '_', str(value))}" for key, value in sorted(labels.items())]
+    return f"{name}|{','.join(pairs)}"
+
+
+def increment(name: str, value: float = 1, **labels) -> None:
+    """
+    Add to a counter of this process, to be merged into Redis on the next flush
+    """
+    series = _get_series(name, labels)
+    with _lock:
+        _counters[series] = _counters.get(series, 0) + value
+
+
+def observe(name: str, value_ms: float, **labels) -> None:
+    """
+    Record a latency in a histogram of this process, to be merged into Redis on the next flush
+    """
+    series = _get_series(name, labels)
+    bucket = next((str(bound) for bound in LATENCY_BUCKETS_MS if value_ms <= bound), '+Inf')
+    with _lock:
+        for field, value in ((f'{series}|{bucket}', 1), (f'{series}|sum', value_ms), (f'{series}|count', 1)):
+            _histograms[field] = _histograms.get(field, 0) + value
+
+
+@contextmanager
+def timed(name: str, **labels):
+    """
+    Record how long the block takes in a latency histogram
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, (time.perf_counter() - start) * 1000, **labels)
+
+
+def flush_metrics() -> None:
+    """
+    Merge the metrics collected by this process since the last flush into the totals in Redis, in one round trip
+    """
+    global _counters, _histograms
+    with _lock:
+        counters, _counters = _counters, {}
+        histograms, _histograms = _histograms, {}
+    if not counters and not histograms:
+        return
+    # Imported here since the Redis client itself reports to this module
+    from utils.logging import get_redis_client
+    try:
+        pipe = get_redis_client().pipeline(transaction=False)
+        for key, deltas in ((COUNTERS_KEY, counters), (HISTOGRAMS_KEY, histograms)):
+            for field, value in deltas.items():
+                pipe.hincrbyfloat(key, field, value)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Error flushing metrics, dropping them: {e}", exc_info=True, stack_info=True)
+
+
+def _format_series(name: str, labels: str, extra: str = '') -> str:
+    pairs = [f'{key}="{value}"' for key, value in (pair.split('=', 1) for pair in labels.split(',') if pair)]
+    if extra:
+        pairs.append(extra)
+    return f"{name}{{{','.join(pairs)}}}" if pairs else name
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+def render_metrics() -> str:
+    """
+    Render the totals merged from every activation in the Prometheus text format
+    """
+    from utils.logging import get_redis_client
+    pipe = get_redis_client().pipeline(transaction=False)
+    pipe.hgetall(COUNTERS_KEY)
+    pipe.hgetall(HISTOGRAMS_KEY)
+    counters, histograms = pipe.execute()
+    lines = []
+    counter_series: dict[str, list[str]] = {}
+    for field, value in counters.items():
+        name, labels = field.decode('utf-8').split('|', 1)
+        counter_series.setdefault(name, []).append(f"{_format_series(name, labels)} {_format_value(float(value))}")
+    for name in sorted(counter_series):
+        lines.append(f"# TYPE {name} counter")
+        lines.extend(sorted(counter_series[name]))
+    histogram_series: dict[tuple[str, str], dict[str, float]] = {}
+    for field, value in histograms.items():
+        name, labels, part = field.decode('utf-8').split('|', 2)
+        histogram_series.setdefault((name, labels), {})[part] = float(value)
+    previous_name = None
+    for (name, labels), parts in sorted(histogram_series.items()):
+        if name != previous_name:
+            lines.append(f"# TYPE {name} histogram")
+            previous_name = name
+        cumulative = 0
+        for bound in (*map(str, LATENCY_BUCKETS_MS), '+Inf'):
+            cumulative += parts.get(bound, 0)
+            bucket_label = f'le="{bound}"'
+            lines.append(f"{_format_series(name + '_bucket', labels, bucket_label)} {_format_value(cumulative)}")
+        lines.append(f"{_format_series(name + '_sum', labels)} {_format_value(parts.get('sum', 0))}")
+        lines.append(f"{_format_series(name + '_count', labels)} {_format_value(parts.get('count', 0))}")
+    return '\n'.join(lines) + '\n'
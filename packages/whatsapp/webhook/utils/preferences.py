@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import logging
+from utils.metrics import increment
+from utils.logging import get_redis_client
+
+
+logger = logging.getLogger(__name__)
+PREFERENCES_CACHE_TTL = float(os.getenv('PREFERENCES_CACHE_TTL') or 300)
+LEGACY_VOICE_KEY = "{sender}|voice_short_name|lang|gender"
+_preferences_cache: dict[str, tuple[float, dict]] = {}
+
+
+def get_preferences_key(sender: str) -> str:
+    """
+    Get the Redis hash key that holds every preference of a sender
+    """
+    return f"prefs:{sender}"
+
+
+def _read_cache(sender: str) -> dict | None:
+    cached = _preferences_cache.get(sender)
+    if cached is None:
+        return None
+    expires_at, preferences = cached
+    if expires_at < time.monotonic():
+        _preferences_cache.pop(sender, None)
+        return None
+    return preferences
+
+
+def _write_cache(sender: str, preferences: dict) -> None:
+    _preferences_cache[sender] = (time.monotonic() + PREFERENCES_CACHE_TTL, preferences)
+
+
+def _decode_preferences(raw: dict[bytes, bytes]) -> dict:
+    return {field.decode('utf-8'): json.loads(value) for field, value in raw.items()}
+
+
+def _migrate_legacy_preferences(sender: str) -> dict:
+    """
+    Move the preferences stored under the old pipe-joined keys into the sender's hash
+    """
+    r = get_redis_client()
+    legacy_key = LEGACY_VOICE_KEY.format(sender=sender)
+    legacy_voice = r.get(legacy_key)
+    if not legacy_voice:
+        return {}
+    short_name, lang, gender = legacy_voice.decode('utf-8').split('|')
+    preferences = {'voice': {'short_name': short_name, 'lang': lang, 'gender': gender}}
+    logger.debug(f"Migrating legacy preferences for {sender=}: {preferences=}")
+    pipe = r.pipeline()
+    pipe.hset(get_preferences_key(sender), mapping={field: json.dumps(value, separators=(',', ':')) for field, value in preferences.items()})
+    pipe.delete(legacy_key, f'{legacy_key}-timestamp')
+    pipe.execute()
+    return preferences
+
+
+def get_bulk_preferences(senders: list[str]) -> dict[str, dict]:
+    """
+    Get the preferences of several senders, reading from Redis in a single round trip only those not cached in this process
+    """
+    result = {}
+    missing = []
+    for sender in senders:
+        preferences = _read_cache(sender)
+        if preferences is None:
+            missing.append(sender)
+        else:
+            result[sender] = preferences
+        increment('cache_requests_total', cache='preferences', result='miss' if preferences is None else 'hit')
+    if missing:
+        pipe = get_redis_client().pipeline(transaction=False)
+        for sender in missing:
+            pipe.hgetall(get_preferences_key(sender))
+        for sender, raw in zip(missing, pipe.execute()):
+            preferences = _decode_preferences(raw) if raw else _migrate_legacy_preferences(sender)
+            _write_cache(sender, preferences)
+            result[sender] = preferences
+    return result
+
+
+def get_preferences(sender: str) -> dict:
+    """
+    Get every preference of a sender
+    """
+    return get_bulk_preferences([sender])[sender]
+
+
+def get_preference(sender: str, name: str, default=None):
+    """
+    Get a single preference of a sender, or the default if it isn't set
+    """
+    return get_preferences(sender).get(name, default)
+
+
+def set_preferences(sender: str, **preferences) -> None:
+    """
+    Save one or more preferences of a sender to Redis, writing them through to this process' cache
+    """
+    logger.debug(f"Saving preferences {preferences=} for {sender=}")
+    get_redis_client().hset(
+        get_preferences_key(sender),
+        mapping={field: json.dumps(value, separators=(',', ':')) for field, value in preferences.items()}
+    )
+    cached = _read_cache(sender)
+    if cached is None:
+        _preferences_cache.pop(sender, None)
+    else:
+        _write_cache(sender, {**cached, **preferences})
@@ -0,0 +1,134 @@
+import io
+import os
+import sys
+import time
+import pstats
+import random
+import cProfile
+import logging
+import tempfile
+import threading
+import tracemalloc
+from functools import wraps
+from contextvars import ContextVar
+from utils.metrics import increment, flush_metrics
+
+
+logger = logging.getLogger(__name__)
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', '').lower() in ('1', 'true')
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE') or 0)
+PROFILING_TOP_N = int(os.getenv('PROFILING_TOP_N') or 30)
+PROFILING_TRACEBACK_FRAMES = 5
+PROFILES_PREFIX = 'profiles'
+
+
+class ActivationProfile:
+    """
+    The CPU profiles collected in every thread that worked on a single activation
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles: list[cProfile.Profile] = []
+
+    def add(self, profile: cProfile.Profile) -> None:
+        with self.lock:
+            self.profiles.append(profile)
+
+    def get_stats(self) -> pstats.Stats | None:
+        with self.lock:
+            profiles = list(self.profiles)
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0], stream=io.StringIO())
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+_activation_profile: ContextVar[ActivationProfile | None] = ContextVar('activation_profile', default=None)
+
+
+def should_profile() -> bool:
+    return PROFILING_ENABLED or (PROFILING_SAMPLE_RATE > 0 and random.random() < PROFILING_SAMPLE_RATE)
+
+
+def run_profiled(func, *args, **kwargs):
+    """
+    Run a function in the current thread, adding its CPU profile to the activation's when it's being profiled
+    """
+    activation_profile = _activation_profile.get()
+    # cProfile only follows the thread that enabled it, and a thread can only run one profiler at a time
+    if activation_profile is None or sys.getprofile() is not None:
+        return func(*args, **kwargs)
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profile.disable()
+        activation_profile.add(profile)
+
+
+def summarize_profile(stats: pstats.Stats | None, snapshot: tracemalloc.Snapshot, peak_bytes: int, elapsed: float, activation_id: str) -> str:
+    """
+    Summarize an activation's profile as text: where the CPU time went, and which lines allocated the most memory
+    """
+    summary = io.StringIO()
+    summary.write(f"Activation {activation_id}: {elapsed * 1000:.0f} ms wall time, {peak_bytes / 2 ** 20:.1f} MiB peak traced memory\n\n")
+    if stats is not None:
+        stats.stream = summary
+        summary.write(f"Top {PROFILING_TOP_N} functions by cumulative time\n")
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILING_TOP_N)
+        summary.write(f"Top {PROFILING_TOP_N} functions by own time\n")
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(PROFILING_TOP_N)
+    summary.write(f"Top {PROFILING_TOP_N} lines by memory still allocated at the end\n")
+    for statistic in snapshot.statistics('lineno')[:PROFILING_TOP_N]:
+        summary.write(f"{statistic}\n")
+    return summary.getvalue()
+
+
+def save_profile(activation_id: str, stats: pstats.Stats | None, summary: str) -> None:
+    """
+    Upload the raw profile, readable with `pstats`, and its summary to DigitalOcean Spaces under the activation ID
+    """
+    # Imported here since the media utilities themselves run through this module
+    from utils.media import put_media_file_to_spaces
+    if stats is not None:
+        with tempfile.NamedTemporaryFile(suffix='.pstats') as dump:
+            stats.dump_stats(dump.name)
+            dump.seek(0)
+            put_media_file_to_spaces(f'{PROFILES_PREFIX}/{activation_id}/profile.pstats', io.BytesIO(dump.read()), 'application/octet-stream')
+    put_media_file_to_spaces(f'{PROFILES_PREFIX}/{activation_id}/summary.txt', io.BytesIO(summary.encode('utf-8')), 'text/plain')
+
+
+def profiled(func):
+    """
+    Profile the CPU time and memory allocations of sampled webhook activations, and save them to DigitalOcean Spaces.
+    Activations that aren't sampled, and GET requests, run untouched
+    """
+    @wraps(func)
+    def wrapper(event: dict, ctx):
+        if not should_profile() or event.get('http', {}).get('method') != 'POST' or tracemalloc.is_tracing():
+            return func(event, ctx)
+        activation_profile = ActivationProfile()
+        token = _activation_profile.set(activation_profile)
+        tracemalloc.start(PROFILING_TRACEBACK_FRAMES)
+        start = time.perf_counter()
+        try:
+            return run_profiled(func, event, ctx)
+        finally:
+            elapsed = time.perf_counter() - start
+            snapshot = tracemalloc.take_snapshot()
+            _, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            _activation_profile.reset(token)
+            try:
+                stats = activation_profile.get_stats()
+                save_profile(ctx.activation_id, stats, summarize_profile(stats, snapshot, peak_bytes, elapsed, ctx.activation_id))
+                increment('profiled_activations_total')
+                logger.info(f"ActvID {ctx.activation_id} Saved the activation's profile under {PROFILES_PREFIX}/{ctx.activation_id}/")
+            except Exception as e:
+                logger.error(f"ActvID {ctx.activation_id} Error saving the activation's profile: {e}", exc_info=True, stack_info=True)
+            # The activation already flushed its metrics, before the profile was saved
+            flush_metrics()
+    return wrapper
@@ -0,0 +1,154 @@
+import logging
+import numpy as np
+from io import BytesIO
+from PIL import Image, ImageFilter
+
+
+logger = logging.getLogger(__name__)
+# The mask is computed on a downscaled copy and upsampled back, since subject outlines don't need full resolution
+SEGMENTATION_MAX_DIMENSION = 384
+BORDER_FRACTION = 0.04
+BACKGROUND_CLUSTERS = 4
+KMEANS_ITERATIONS = 8
+KMEANS_MAX_SAMPLES = 4096
+MIN_COLOR_THRESHOLD = 10.0
+LUMINANCE_WEIGHT = 0.5  # Shadows and uneven lighting mostly change luminance, so it counts less than chroma
+FLOOD_STEPS_PER_CHECK = 8
+MASK_FEATHER_RADIUS = 1.5
+
+
+def _to_color_space(pixels: np.ndarray) -> np.ndarray:
+    """
+    Convert RGB pixels to a luminance/opponent-color space where euclidean distances weigh chroma over brightness
+    """
+    r, g, b = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    luminance = (r + g + b) / 3 * LUMINANCE_WEIGHT
+    red_green = r - g
+    yellow_blue = (r + g) / 2 - b
+    return np.stack([luminance, red_green, yellow_blue], axis=-1)
+
+
+def _get_border(array: np.ndarray, width: int) -> np.ndarray:
+    return np.concatenate([
+        array[:width].reshape(-1, *array.shape[2:]),
+        array[-width:].reshape(-1, *array.shape[2:]),
+        array[width:-width, :width].reshape(-1, *array.shape[2:]),
+        array[width:-width, -width:].reshape(-1, *array.shape[2:]),
+    ])
+
+
+def _kmeans(samples: np.ndarray, k: int) -> np.ndarray:
+    """
+    Cluster the samples into k colors, deterministically seeded along the luminance axis
+    """
+    if len(samples) > KMEANS_MAX_SAMPLES:
+        samples = samples[::len(samples) // KMEANS_MAX_SAMPLES]
+    order = np.argsort(samples[:, 0])
+    centers = samples[order[np.linspace(0, len(samples) - 1, k).astype(int)]].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        labels = ((samples[:, None, :] - centers[None, :, :]) ** 2).sum(axis=-1).argmin(axis=1)
+        for i in range(k):
+            members = samples[labels == i]
+            if len(members):
+                centers[i] = members.mean(axis=0)
+    return centers
+
+
+def _distance_to_centers(pixels: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    distance = np.full(pixels.shape[:-1], np.inf, dtype=np.float32)
+    for center in centers:
+        np.minimum(distance, np.sqrt(((pixels - center) ** 2).sum(axis=-1)), out=distance)
+    return distance
+
+
+def _gradient_magnitude(luminance: np.ndarray) -> np.ndarray:
+    gradient_x = np.zeros_like(luminance)
+    gradient_y = np.zeros_like(luminance)
+    gradient_x[:, 1:-1] = luminance[:, 2:] - luminance[:, :-2]
+    gradient_y[1:-1, :] = luminance[2:, :] - luminance[:-2, :]
+    return np.hypot(gradient_x, gradient_y)
+
+
+def _dilate(mask: np.ndarray) -> np.ndarray:
+    """
+    Grow a boolean mask by one pixel in all 8 directions
+    """
+    grown = mask.copy()
+    grown[1:, :] |= mask[:-1, :]
+    grown[:-1, :] |= mask[1:, :]
+    grown[:, 1:] |= mask[:, :-1]
+    grown[:, :-1] |= mask[:, 1:]
+    grown[1:, 1:] |= mask[:-1, :-1]
+    grown[1:, :-1] |= mask[:-1, 1:]
+    grown[:-1, 1:] |= mask[1:, :-1]
+    grown[:-1, :-1] |= mask[1:, 1:]
+    return grown
+
+
+def _erode(mask: np.ndarray) -> np.ndarray:
+    return ~_dilate(~mask)
+
+
+def _flood_from_border(candidates: np.ndarray) -> np.ndarray:
+    """
+    Get the candidate pixels connected to the image border through other candidate pixels
+    """
+    reached = np.zeros_like(candidates)
+    reached[0, :], reached[-1, :], reached[:, 0], reached[:, -1] = candidates[0, :], candidates[-1, :], candidates[:, 0], candidates[:, -1]
+    while True:
+        previous_count = np.count_nonzero(reached)
+        for _ in range(FLOOD_STEPS_PER_CHECK):
+            reached = _dilate(reached) & candidates
+        if np.count_nonzero(reached) == previous_count:
+            return reached
+
+
+def compute_foreground_mask(image: Image.Image) -> np.ndarray:
+    """
+    Estimate which pixels of an image belong to its subject, as a float mask between 0 and 1. The background is
+    modelled by clustering the colors along the image border, and is then grown inwards from the border over
+    pixels close to one of those colors that aren't on a strong edge. Whatever the background can't reach,
+    including enclosed holes, is the subject
+    """
+    pixels = _to_color_space(np.asarray(image.convert("RGB"), dtype=np.float32))
+    height, width = pixels.shape[:2]
+    border_width = max(1, int(min(height, width) * BORDER_FRACTION))
+    centers = _kmeans(_get_border(pixels, border_width), BACKGROUND_CLUSTERS)
+    distance = _distance_to_centers(pixels, centers)
+    color_threshold = max(np.percentile(_get_border(distance, border_width), 95) * 1.5, MIN_COLOR_THRESHOLD)
+    gradient = _gradient_magnitude(pixels[..., 0] / LUMINANCE_WEIGHT)
+    edge_threshold = max(np.percentile(gradient, 90), MIN_COLOR_THRESHOLD)
+    background = _flood_from_border((distance < color_threshold) & (gradient < edge_threshold))
+    # The edge pixels the flood stopped at belong to the background when they sit right next to it
+    background |= _dilate(background) & (distance < color_threshold)
+    foreground = ~background
+    # Open to drop specks, then close to seal small gaps in the outline
+    foreground = _dilate(_erode(foreground))
+    foreground = _erode(_dilate(foreground))
+    return foreground.astype(np.float32)
+
+
+def remove_background(image_buffer: BytesIO) -> tuple[BytesIO, str]:
+    """
+    Cut the subject of an image out of its background, returning it as an RGBA image with a transparent background
+    """
+    image = Image.open(image_buffer)
+    image.load()
+    image = image.convert("RGB")
+    scale = min(1.0, SEGMENTATION_MAX_DIMENSION / max(image.size))
+    small = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.Resampling.BILINEAR) if scale < 1.0 else image
+    mask = compute_foreground_mask(small)
+    coverage = mask.mean()
+    logger.debug(f"Computed foreground mask of {small.size} covering {coverage:.1%} of the image")
+    if coverage == 0.0 or coverage > 0.98:
+        logger.warning(f"Couldn't tell the subject apart from the background ({coverage:.1%} coverage), keeping the whole image")
+        mask.fill(1.0)
+    alpha = Image.fromarray((mask * 255).astype(np.uint8))
+    alpha = alpha.resize(image.size, Image.Resampling.BILINEAR).filter(ImageFilter.GaussianBlur(MASK_FEATHER_RADIUS / scale ** 0.5))
+    image.putalpha(alpha)
+    # The cutout is only an intermediate, and uncompressed TIFF encodes many times faster than even a barely
+    # compressed PNG while keeping the alpha channel
+    tiff_buffer = BytesIO()
+    image.save(tiff_buffer, "TIFF")
+    tiff_buffer.seek(0)
+    return tiff_buffer, "image/tiff"
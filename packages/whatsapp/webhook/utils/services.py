@@ -0,0 +1,264 @@
+import time
+import random
+import logging
+import requests
+import threading
+from functools import lru_cache
+from contextvars import ContextVar
+from contextlib import contextmanager
+from collections import namedtuple
+from utils.metrics import increment, observe
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceUnavailableError(Exception):
+    def __init__(self, message: str):
+        self.message = message
+        super().__init__(self.message)
+
+
+CallPolicy = namedtuple(
+    "CallPolicy",
+    [
+        "name",
+        "connect_timeout",
+        "read_timeout",
+        "retries",
+        "hedge_after",
+        "failure_threshold",
+        "cooldown",
+    ],
+)
+
+
+# Per attempt limits. Across attempts, every call is also bounded by the deadline of the activation making it
+POLICIES = {
+    'graph': CallPolicy(name="WhatsApp", connect_timeout=3.05, read_timeout=10, retries=2, hedge_after=1.5, failure_threshold=5, cooldown=30),
+    'openai': CallPolicy(name="OpenAI", connect_timeout=3.05, read_timeout=25, retries=1, hedge_after=None, failure_threshold=3, cooldown=60),
+    'speech': CallPolicy(name="Azure Speech", connect_timeout=3.05, read_timeout=10, retries=2, hedge_after=None, failure_threshold=3, cooldown=60),
+    'vision': CallPolicy(name="Azure Vision", connect_timeout=3.05, read_timeout=15, retries=1, hedge_after=None, failure_threshold=3, cooldown=60),
+    'functions': CallPolicy(name="ASCII Art", connect_timeout=3.05, read_timeout=25, retries=0, hedge_after=None, failure_threshold=3, cooldown=30),
+}
+RETRY_BASE_DELAY = 0.25
+RETRY_MAX_DELAY = 2.0
+# Time kept after the last call of an activation to reply to the user, and the shortest attempt worth making
+DEADLINE_MARGIN = 2.0
+MIN_ATTEMPT_TIME = 1.0
+_deadline: ContextVar[float | None] = ContextVar('call_deadline', default=None)
+HEDGE_THREADS = 8
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_THREADS, thread_name_prefix='hedge')
+# Held by every request running in the hedging pool, so a request is only handed to it when a thread is free
+_hedge_slots = threading.BoundedSemaphore(HEDGE_THREADS)
+
+
+class CircuitBreaker:
+    """
+    Track the consecutive failures of a service, and fail fast for a cooldown period once they reach the threshold
+    """
+    def __init__(self, policy: CallPolicy):
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.policy.cooldown:
+                # Half open: let calls through, a single failure opens it again
+                self.failures = self.policy.failure_threshold - 1
+                self.opened_at = None
+                return True
+            return False
+
+    def get_cooldown_remaining(self) -> float:
+        """
+        Get how long until calls are let through again, or 0 if they already are
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(self.opened_at + self.policy.cooldown - time.monotonic(), 0.0)
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.policy.failure_threshold and self.opened_at is None:
+                logger.warning(f"Opening circuit breaker for {self.policy.name} after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+
+
+@lru_cache(maxsize=None)
+def get_session(service: str) -> requests.Session:
+    """
+    Get the HTTP session of a service, shared by every caller in the current process so connections are reused
+    """
+    return requests.Session()
+
+
+@lru_cache(maxsize=None)
+def get_circuit_breaker(service: str) -> CircuitBreaker:
+    return CircuitBreaker(POLICIES[service])
+
+
+def _is_retryable_status(status_code: int, idempotent: bool) -> bool:
+    return status_code == 429 or (idempotent and status_code >= 500)
+
+
+def _get_retry_delay(attempt: int, response: requests.Response | None) -> float:
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after is not None and retry_after.isdigit():
+        return min(float(retry_after), RETRY_MAX_DELAY)
+    # Full jitter, so retries from concurrent activations don't synchronize
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def _has_time_for_retry(delay: float) -> bool:
+    remaining = _get_remaining_time()
+    return remaining is None or remaining - delay >= MIN_ATTEMPT_TIME
+
+
+def _get_rewind_positions(kwargs: dict) -> list[tuple]:
+    """
+    Get the file-like bodies of a request with their positions, so they can be rewound before a retry
+    """
+    bodies = [kwargs.get('data')]
+    bodies += [value[1] for value in (kwargs.get('files') or {}).values() if isinstance(value, tuple) and len(value) > 1]
+    return [(body, body.tell()) for body in bodies if hasattr(body, 'seek') and hasattr(body, 'tell')]
+
+
+def _send(service: str, method: str, url: str, timeout: tuple[float, float], kwargs: dict) -> requests.Response:
+    return get_session(service).request(method, url, timeout=timeout, **kwargs)
+
+
+@contextmanager
+def call_deadline(ctx, margin: float = DEADLINE_MARGIN):
+    """
+    Bound every external call made within the block, including those in worker threads started from it, by the
+    remaining time of the activation minus a margin
+    """
+    remaining_ms = ctx.get_remaining_time_in_millis()
+    deadline = time.monotonic() + remaining_ms / 1000 - margin if remaining_ms >= 0 else None
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def _get_remaining_time() -> float | None:
+    deadline = _deadline.get()
+    return deadline - time.monotonic() if deadline is not None else None
+
+
+def _submit_hedged(service: str, method: str, url: str, timeout: tuple[float, float], kwargs: dict) -> Future | None:
+    """
+    Run a request in the hedging pool if one of its threads is free, or get None, so requests never queue in it
+    """
+    if not _hedge_slots.acquire(blocking=False):
+        return None
+    future = _hedge_executor.submit(_send, service, method, url, timeout, kwargs)
+    future.add_done_callback(lambda _: _hedge_slots.release())
+    return future
+
+
+def _send_hedged(service: str, method: str, url: str, timeout: tuple[float, float], hedge_after: float, kwargs: dict) -> requests.Response:
+    """
+    Send a request, and if it hasn't answered after the hedging delay send a duplicate and keep the first answer.
+    While the hedging pool is busy the request is sent without a duplicate, and within a `call_deadline` the wait
+    for an answer ends with the deadline
+    """
+    first = _submit_hedged(service, method, url, timeout, kwargs)
+    if first is None:
+        increment('hedged_requests_skipped_total', provider=service)
+        return _send(service, method, url, timeout, kwargs)
+    remaining = _get_remaining_time()
+    done, _ = wait([first], timeout=hedge_after if remaining is None else max(min(hedge_after, remaining), 0))
+    if done:
+        return first.result()
+    pending = {first}
+    second = _submit_hedged(service, method, url, timeout, kwargs)
+    if second is None:
+        increment('hedged_requests_skipped_total', provider=service)
+    else:
+        logger.debug(f"Hedging {method} {url} after {hedge_after}s without an answer")
+        pending.add(second)
+    error = None
+    while pending:
+        remaining = _get_remaining_time()
+        done, pending = wait(pending, timeout=None if remaining is None else max(remaining, 0), return_when=FIRST_COMPLETED)
+        if not done:
+            # The requests left behind finish in the background, within their own timeouts
+            raise requests.Timeout(f"No answer from {method} {url} before the deadline")
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+def call_service(service: str, method: str, url: str, idempotent: bool | None = None, hedge: bool = False, read_timeout: float | None = None, **kwargs) -> requests.Response:
+    """
+    Make an HTTP request to an external service following its call policy: connect and read timeouts, jittered
+    retries on connect timeouts and 429s (and on any connection error, timeout or 5xx for idempotent requests), a
+    circuit breaker that
+    fails fast while the service is down, and optionally a hedged duplicate for slow requests. Within a
+    `call_deadline`, attempts are cut short and retries skipped so the call ends before the activation does. Requests
+    are idempotent by default only if they are GETs. The final response is returned without checking its status
+    """
+    policy = POLICIES[service]
+    breaker = get_circuit_breaker(service)
+    if idempotent is None:
+        idempotent = method.upper() == 'GET'
+    if not breaker.allow():
+        increment('external_call_errors_total', provider=service, reason='circuit_open')
+        raise ServiceUnavailableError(f"Lo siento, el servicio de {policy.name} no está disponible en este momento. Por favor, intenta de nuevo en unos minutos.")
+    rewind_positions = _get_rewind_positions(kwargs)
+    for attempt in range(policy.retries + 1):
+        remaining = _get_remaining_time()
+        if remaining is not None and remaining < MIN_ATTEMPT_TIME:
+            increment('external_call_errors_total', provider=service, reason='deadline')
+            raise ServiceUnavailableError(f"Lo siento, el servicio de {policy.name} está tardando demasiado en responder. Por favor, intenta de nuevo en unos minutos.")
+        timeout = (policy.connect_timeout, read_timeout or policy.read_timeout)
+        if remaining is not None:
+            timeout = (min(timeout[0], remaining), min(timeout[1], remaining))
+        for body, position in rewind_positions:
+            body.seek(position)
+        response = None
+        start = time.perf_counter()
+        try:
+            if hedge and idempotent and policy.hedge_after is not None:
+                response = _send_hedged(service, method, url, timeout, policy.hedge_after, kwargs)
+            else:
+                response = _send(service, method, url, timeout, kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            increment('external_call_errors_total', provider=service, reason=type(e).__name__)
+            # A connect timeout means the request never reached the service, so it's safe to retry either way
+            retryable = idempotent or isinstance(e, requests.ConnectTimeout)
+            delay = _get_retry_delay(attempt, response)
+            if attempt == policy.retries or not retryable or not _has_time_for_retry(delay):
+                breaker.record_failure()
+                raise
+            logger.warning(f"Retrying {method} {url} to {policy.name} after attempt {attempt + 1} failed: {e}")
+        else:
+            observe('external_call_duration_ms', (time.perf_counter() - start) * 1000, provider=service)
+            if response.status_code >= 400:
+                increment('external_call_errors_total', provider=service, reason=str(response.status_code))
+            delay = _get_retry_delay(attempt, response)
+            if not _is_retryable_status(response.status_code, idempotent) or attempt == policy.retries or not _has_time_for_retry(delay):
+                if response.status_code >= 500:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                return response
+            logger.warning(f"Retrying {method} {url} to {policy.name} after attempt {attempt + 1} got status {response.status_code}")
+        time.sleep(delay)
@@ -1,13 +1,17 @@
 import os
+import time
 import logging
 import hashlib
-import requests
 from io import BytesIO
-from utils.logging import log_to_redis, read_from_redis
+from utils.services import call_service
+from utils.preferences import get_preference, set_preferences
 from utils.media import validate_audio_mime_type, get_media_metadata, get_media_file_from_meta
 
 
 logger = logging.getLogger(__name__)
+DEFAULT_VOICE = {'short_name': 'en-US-JennyNeural', 'lang': 'en-US', 'gender': 'female'}
+VOICE_LIST_CACHE_TTL = float(os.getenv('VOICE_LIST_CACHE_TTL') or 24 * 60 * 60)
+_voice_list_cache: tuple[float, list[dict[str, str]]] | None = None
 
 
 def convert_audio_to_text(audio_buffer: BytesIO, audio_mime_type: str) -> str:
@@ -22,7 +26,8 @@ def convert_audio_to_text(audio_buffer: BytesIO, audio_mime_type: str) -> str:
         'model': (None, 'whisper-1'),
         'temperature': (None, '0.7'),
     }
-    response = requests.post('https://api.openai.com/v1/audio/transcriptions', headers=headers, files=files)
+    response = call_service('openai', 'POST', 'https://api.openai.com/v1/audio/transcriptions', idempotent=True, headers=headers, files=files)
+    response.raise_for_status()
     return response.json()['text']
 
 
@@ -35,7 +40,7 @@ def transcribe_audio(audio_id: str) -> list[str]:
         return [f"Lo siento, el formato del audio no es válido. Los formatos válidos son: flac, mp3, mp4, mpeg, mpga, m4a, ogg, wav y webm. El formato del audio que enviaste es: `{file_mime_type}`"]
     if file_size > 25 * 1024 * 1024:
         return [f"Lo siento, el tamaño del audio es muy grande. El tamaño máximo permitido es de 25MB. El tamaño del audio que enviaste es: `{file_size} bytes, {file_size / (1024 * 1024)} MB`"]
-    with get_media_file_from_meta(file_url, media_id=audio_id) as audio_file:
+    with get_media_file_from_meta(file_url, media_id=audio_id, file_hash=file_hash) as audio_file:
         file_bytes = audio_file.getvalue()
         hashed_file = hashlib.sha256(file_bytes).hexdigest()
         if hashed_file != file_hash:
@@ -49,16 +54,21 @@ def transcribe_audio(audio_id: str) -> list[str]:
 
 def get_voice_list(search_term: str = None) -> list[dict[str, str]]:
     """
-    Get the list of voices available in the Microsoft Speech API
+    Get the list of voices available in the Microsoft Speech API, cached in this process since it rarely changes
     """
-    url = f"https://{os.getenv('MS_SPEECH_REGION')}.tts.speech.microsoft.com/cognitiveservices/voices/list"
-    headers = {
-        "Ocp-Apim-Subscription-Key": f"{os.getenv('MS_SPEECH_KEY')}",
-        "User-Agent": "doslsfn:whatsapp_utils:v1.1"
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    voices_list = [{'short_name': voice["ShortName"], 'lang': voice["Locale"], 'gender': voice["Gender"]} for voice in response.json()]
+    global _voice_list_cache
+    if _voice_list_cache is not None and _voice_list_cache[0] > time.monotonic():
+        voices_list = _voice_list_cache[1]
+    else:
+        url = f"https://{os.getenv('MS_SPEECH_REGION')}.tts.speech.microsoft.com/cognitiveservices/voices/list"
+        headers = {
+            "Ocp-Apim-Subscription-Key": f"{os.getenv('MS_SPEECH_KEY')}",
+            "User-Agent": "doslsfn:whatsapp_utils:v1.1"
+        }
+        response = call_service('speech', 'GET', url, headers=headers)
+        response.raise_for_status()
+        voices_list = [{'short_name': voice["ShortName"], 'lang': voice["Locale"], 'gender': voice["Gender"]} for voice in response.json()]
+        _voice_list_cache = (time.monotonic() + VOICE_LIST_CACHE_TTL, voices_list)
     if search_term:
         voices_list = [voice for voice in voices_list if search_term.lower() in voice['short_name'].lower() or search_term.lower() in voice['lang'].lower() or search_term in voice['gender'].lower()]
     return voices_list
@@ -66,22 +76,23 @@ def get_voice_list(search_term: str = None) -> list[dict[str, str]]:
 
 def save_voice(sender: str, voice: dict[str, str]) -> None:
     """
-    Save the chosen voice to Redis
+    Save the chosen voice to the sender's preferences
     """
+    if not voice:
+        raise ValueError(f"Refusing to save an empty voice for {sender=}")
     logger.debug(f"Saving voice {voice=} for {sender=}")
-    log_to_redis(key=f"{sender}|voice_short_name|lang|gender", value=f"{voice['short_name']}|{voice['lang']}|{voice['gender']}", value_is_sender=False)
+    set_preferences(sender, voice=voice)
 
 
 def get_voice(sender: str) -> dict[str, str]:
     """
-    Get the chosen voice from Redis. If there is no voice saved, return the default voice
+    Get the chosen voice from the sender's preferences. If there is no voice saved, return the default voice
     """
-    voice = read_from_redis(f"{sender}|voice_short_name|lang|gender")
+    voice = get_preference(sender, 'voice')
     if not voice:
-        return {'short_name': 'en-US-JennyNeural', 'lang': 'en-US', 'gender': 'female'}
-    voice = voice.split('|')
+        return dict(DEFAULT_VOICE)
     logger.debug(f"Getting voice for {sender=}: {voice=}")
-    return {'short_name': voice[0], 'lang': voice[1], 'gender': voice[2]}
+    return voice
 
 
 def read_text(text: str, voice: dict[str, str]) -> tuple[BytesIO, str]:
@@ -102,6 +113,6 @@ def read_text(text: str, voice: dict[str, str]) -> tuple[BytesIO, str]:
         </voice>
     </speak>
     """
-    response = requests.post(url, headers=headers, data=body.encode('utf-8'))
+    response = call_service('speech', 'POST', url, idempotent=True, headers=headers, data=body.encode('utf-8'))
     response.raise_for_status()
     return BytesIO(response.content), response.headers['Content-Type']
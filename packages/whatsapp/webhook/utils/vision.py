@@ -2,10 +2,11 @@ import os
 import json
 import logging
 import hashlib
-import requests
 from io import BytesIO
+from utils.services import call_service
+from utils.segmentation import remove_background
 from utils.image import resize_image, parse_image_caption, convert_png_to_jpeg, CaptionParsingError, AsciiArtFlags
-from utils.media import validate_image_mime_type, get_media_metadata, get_media_file_from_meta, get_media_file_from_spaces, post_media_file_to_spaces, delete_media_file_from_spaces
+from utils.media import validate_image_mime_type, get_media_metadata, get_media_file_from_meta, get_media_file_from_spaces, put_media_file_to_spaces, get_media_extension, intermediate_files, track_intermediate_file
 
 
 logger = logging.getLogger(__name__)
@@ -27,8 +28,11 @@ def convert_image_to_text(image_buffer: BytesIO, image_mime_type: str, ctx) -> s
     }
     url = f'{os.getenv("MS_VISION_ENDPOINT")}/computervision/imageanalysis:analyze?features=caption,read&model-version=latest&language=en&api-version=2024-02-01'
     logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Sending image to Microsoft Vision API at {url=}")
-    response = requests.post(
-        url=url,
+    response = call_service(
+        'vision',
+        'POST',
+        url,
+        idempotent=True,
         headers=headers,
         data=image_buffer
     )
@@ -49,7 +53,7 @@ def validate_media(image_id: str, ctx) -> BytesIO:
         raise ImageProcessingError(f"Lo siento, el formato de la imagen no es válido. Los formatos válidos son: jpeg, png y tiff. El formato de la imagen que enviaste es: `{file_mime_type}`")
     if file_size > 25 * 1024 * 1024:
         raise ImageProcessingError(f"Lo siento, el tamaño de la imagen es muy grande. El tamaño máximo permitido es de 25MB. El tamaño de la imagen que enviaste es: `{file_size} bytes, {file_size / (1024 * 1024)} MB`")
-    with get_media_file_from_meta(file_url, media_id=image_id) as image_file:
+    with get_media_file_from_meta(file_url, media_id=image_id, file_hash=file_hash) as image_file:
         file_bytes = image_file.getvalue()
         hashed_file = hashlib.sha256(file_bytes).hexdigest()
         if hashed_file != file_hash:
@@ -58,20 +62,13 @@ def validate_media(image_id: str, ctx) -> BytesIO:
 
 
 def remove_image_background(image_buffer: BytesIO, image_mime_type: str, ctx) -> tuple[BytesIO, str]:
-    headers = {
-        'Ocp-Apim-Subscription-Key': f"{os.getenv('MS_VISION_KEY')}",
-        'Content-Type': image_mime_type,
-    }
-    url = f'{os.getenv("MS_VISION_ENDPOINT")}/computervision/imageanalysis:segment?api-version=2023-02-01-preview&mode=backgroundRemoval'
-    logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Sending image to Microsoft Vision API at {url=}")
-    response = requests.post(
-        url=url,
-        headers=headers,
-        data=image_buffer
-    )
-    response.raise_for_status()
-    logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Received response from Microsoft Vision API")
-    return BytesIO(response.content), response.headers['Content-Type']
+    """
+    Cut the subject of an image out of its background locally
+    """
+    logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Removing background from {image_mime_type} image")
+    result = remove_background(image_buffer)
+    logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Removed background from {image_mime_type} image")
+    return result
 
 
 def image_to_asciiart(image_id: str, image_buffer: BytesIO, flags: AsciiArtFlags, ctx = None) -> str:
@@ -86,8 +83,11 @@ def image_to_asciiart(image_id: str, image_buffer: BytesIO, flags: AsciiArtFlags
     payload['height'] = height
     payload['media_id'] = image_id
     logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Sending payload {json.dumps(payload)} to ASCII Art API")
-    response = requests.post(
+    response = call_service(
+        'functions',
+        'POST',
         f'{os.getenv("FUNCTIONS_ENDPOINT")}/api/v1/web/{os.getenv("FUNCTIONS_NAMESPACE")}/whatsapp/aic',
+        idempotent=True,
         headers=headers,
         json=payload
     )
@@ -110,7 +110,7 @@ def alter_image(caption: str, image_id: str, ctx) -> tuple[BytesIO, str] | list[
     logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Received {op_name} request on image {image_id}")
     file_url, file_hash, file_mime_type, file_size = get_media_metadata(image_id)
     logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Retrieved metadata of image {image_id}: {file_url}, {file_hash}, {file_mime_type}, {file_size}")
-    with validate_media(image_id, ctx) as image_file:
+    with intermediate_files(), validate_media(image_id, ctx) as image_file:
         if 'i2t' in op:
             transcription = convert_image_to_text(image_file, file_mime_type, ctx)
             logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Returning {op_name} result")
@@ -123,17 +123,19 @@ def alter_image(caption: str, image_id: str, ctx) -> tuple[BytesIO, str] | list[
             logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Removed background from image {image_id}")
             background_color_name = parsed_caption[2].background_color_name if isinstance(parsed_caption[2], AsciiArtFlags) else parsed_caption[2]
             image_file, file_mime_type = convert_png_to_jpeg(image_file, background_color_name, ctx=ctx)
-        if 'i2a' in op and 'bg' in op:
-            post_media_file_to_spaces(f'{image_id}-bgrm', image_file, file_mime_type)
-            logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Posted image with removed background to DigitalOcean Spaces")
-            image_id = f'{image_id}-bgrm'
         if 'i2a' in op:
+            # The ASCII Art API reads its input from Spaces, keyed by an ID unique to this request
+            if 'bg' in op:
+                image_id = f'{image_id}-bgrm'
+            track_intermediate_file(f'{image_id}.{get_media_extension(file_mime_type)}')
+            put_media_file_to_spaces(f'{image_id}.{get_media_extension(file_mime_type)}', image_file, file_mime_type)
+            image_file.seek(0)
+            logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Posted image {image_id} to DigitalOcean Spaces")
+            track_intermediate_file(f'{image_id}-ascii-art.png')
             file_key = image_to_asciiart(image_id, image_file, parsed_caption[2], ctx)
-            if image_id.endswith('-bgrm'):
-                delete_media_file_from_spaces(f'{image_id}-bgrm')
             logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Received path {file_key} from ASCII Art API")
-            image_file, file_mime_type = get_media_file_from_spaces(file_key, delete=True), 'image/png'
+            image_file, file_mime_type = get_media_file_from_spaces(file_key), 'image/png'
             background_color_name = parsed_caption[2].background_color_name
-            image_file, file_mime_type = convert_png_to_jpeg(image_file, background_color_name, ctx=ctx)
+            image_file, file_mime_type = convert_png_to_jpeg(image_file, background_color_name, ctx=ctx, text_friendly=True)
         logger.debug(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Returning {op_name} result")
         return image_file, file_mime_type
@@ -0,0 +1,129 @@
+import os
+import time
+import logging
+import threading
+from io import BytesIO
+from PIL import Image
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+from utils.speech import get_voice_list
+from utils.media import get_spaces_client
+from utils.logging import get_redis_client
+from utils.metrics import observe, flush_metrics
+from utils.services import get_session, POLICIES
+
+
+logger = logging.getLogger(__name__)
+WARMUP_BUDGET_MS = int(os.getenv('WARMUP_BUDGET_MS') or 5000)
+# Time left to reply to the healthcheck itself once the budget is spent
+WARMUP_REPLY_MARGIN_MS = 500
+_lock = threading.Lock()
+_warmed_up = False
+_first_message_seen = False
+
+
+def _warm_imaging() -> None:
+    """
+    Load every Pillow plugin and run the codecs once, so the first image doesn't pay for it
+    """
+    Image.init()
+    buffer = BytesIO()
+    Image.new('RGBA', (8, 8)).save(buffer, format='PNG')
+    buffer.seek(0)
+    Image.open(buffer).convert('RGB').save(BytesIO(), format='JPEG')
+
+
+def _warm_redis() -> None:
+    get_redis_client().ping()
+
+
+def _warm_spaces() -> None:
+    get_spaces_client().head_bucket(Bucket=os.getenv('STORAGE_NAME'))
+
+
+def _warm_service(service: str, url: str) -> None:
+    """
+    Open a pooled connection to a service, without going through its call policy since the reply doesn't matter
+    """
+    policy = POLICIES[service]
+    get_session(service).head(url, timeout=(policy.connect_timeout, policy.connect_timeout)).close()
+
+
+def get_warmup_steps() -> dict:
+    """
+    Get the warm-up steps that apply to the current environment, by name
+    """
+    steps = {
+        'imaging': _warm_imaging,
+        'redis': _warm_redis,
+        'spaces': _warm_spaces,
+        'graph': lambda: _warm_service('graph', 'https://graph.facebook.com'),
+        'openai': lambda: _warm_service('openai', 'https://api.openai.com'),
+        # Fetching the catalogue also opens the connection to Azure Speech
+        'voice_list': get_voice_list,
+    }
+    for service, url in (('vision', os.getenv('MS_VISION_ENDPOINT')), ('functions', os.getenv('FUNCTIONS_ENDPOINT'))):
+        if url:
+            steps[service] = lambda service=service, url=url: _warm_service(service, url)
+    return steps
+
+
+def warm_up(ctx, budget_ms: int | None = None) -> dict[str, int | str]:
+    """
+    Run every warm-up step concurrently, giving up on those still running once the budget or the activation's time
+    runs out. Get how long each step took in milliseconds, or why it didn't finish
+    """
+    global _warmed_up
+    budget_ms = budget_ms or WARMUP_BUDGET_MS
+    remaining_ms = ctx.get_remaining_time_in_millis()
+    if remaining_ms >= 0:
+        budget_ms = min(budget_ms, remaining_ms - WARMUP_REPLY_MARGIN_MS)
+    start = time.perf_counter()
+    steps = get_warmup_steps()
+    timings = {}
+
+    def run(name, step):
+        step()
+        timings[name] = round((time.perf_counter() - start) * 1000)
+
+    executor = ThreadPoolExecutor(max_workers=len(steps), thread_name_prefix='warmup')
+    futures = {executor.submit(run, name, step): name for name, step in steps.items()}
+    done, _ = wait(futures, timeout=max(budget_ms, 0) / 1000)
+    # Steps left behind keep running in the background, and whatever they open stays warm for later requests
+    executor.shutdown(wait=False)
+    results = {}
+    for future, name in futures.items():
+        if future not in done:
+            results[name] = 'timeout'
+        elif future.exception() is not None:
+            # The reply goes to whoever asked for the warm-up, so the details only go to the logs
+            logger.warning(f"ActvID {ctx.activation_id} Warm-up step {name} failed: {future.exception()}", exc_info=future.exception())
+            results[name] = 'error'
+        else:
+            results[name] = timings[name]
+    with _lock:
+        _warmed_up = True
+    observe('warmup_duration_ms', (time.perf_counter() - start) * 1000)
+    flush_metrics()
+    logger.info(f"ActvID {ctx.activation_id} Remaining millis {ctx.get_remaining_time_in_millis()} Warmed up with a budget of {budget_ms}ms: {results}")
+    return results
+
+
+@contextmanager
+def timed_first_message(message_type: str):
+    """
+    Record how long the first message handled by this process takes, labeled by whether a warm-up ran before it, to
+    compare the latency of cold starts with and without warm-up
+    """
+    global _first_message_seen
+    with _lock:
+        is_first, _first_message_seen = not _first_message_seen, True
+        warmed = 'true' if _warmed_up else 'false'
+    if not is_first:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('first_message_duration_ms', (time.perf_counter() - start) * 1000, type=message_type, warmed=warmed)
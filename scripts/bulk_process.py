@@ -0,0 +1,163 @@
+"""
+Re-transcribe audios or OCR images archived in DigitalOcean Spaces in bulk, writing the results as JSONL.
+
+Run from the repo root with the webhook's environment loaded, e.g.
+`dotenvx run -- python scripts/bulk_process.py transcribe --prefix media/ --output transcriptions.jsonl`
+
+The output file doubles as the checkpoint: re-running with the same output skips every key that already has a
+result, and retries the ones that failed.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'packages', 'whatsapp', 'webhook'))
+
+from utils.context import ActivationContext
+from utils.services import POLICIES, ServiceUnavailableError, get_circuit_breaker
+from utils.speech import convert_audio_to_text
+from utils.vision import convert_image_to_text
+from utils.media import list_media_files_from_spaces, get_media_file_from_spaces, validate_audio_mime_type, validate_image_mime_type
+
+
+logger = logging.getLogger('bulk_process')
+TASKS = {
+    # task: (mime type family, mime type validator, default max concurrent calls to its API, service of its API)
+    'transcribe': ('audio', validate_audio_mime_type, 4, 'openai'),
+    'ocr': ('image', validate_image_mime_type, 8, 'vision'),
+}
+# Times a key is put back in the queue while its API is unavailable, before it's recorded as failed
+UNAVAILABLE_RETRIES = 10
+
+
+def read_checkpoint(output_path: str) -> set[str]:
+    """
+    Get the keys that already have a successful result in the output file
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding='utf-8') as output:
+        for line in output:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # A line cut short by an interrupted run
+            if 'error' not in record:
+                done.add(record['key'])
+    return done
+
+
+def process_file(task: str, file_key: str, api_slots: threading.Semaphore) -> dict:
+    """
+    Download a file and run the task on it. While the task's API is unavailable, the file is marked `unavailable`
+    so it can be retried later, without downloading it if its circuit breaker is already open
+    """
+    mime_family, _, _, service = TASKS[task]
+    mime_type = f"{mime_family}/{file_key.rsplit('.', 1)[-1]}"
+    start = time.monotonic()
+    if get_circuit_breaker(service).get_cooldown_remaining() > 0:
+        return {'key': file_key, 'task': task, 'unavailable': True}
+    try:
+        media_buffer = get_media_file_from_spaces(file_key)
+        size = media_buffer.getbuffer().nbytes
+        with api_slots:
+            if task == 'transcribe':
+                text = convert_audio_to_text(media_buffer, mime_type)
+            else:
+                text = convert_image_to_text(media_buffer, mime_type, ActivationContext(f'bulk-{file_key}'))
+        return {'key': file_key, 'task': task, 'bytes': size, 'seconds': round(time.monotonic() - start, 3), 'text': text}
+    except ServiceUnavailableError:
+        return {'key': file_key, 'task': task, 'unavailable': True}
+    except Exception as e:
+        logger.warning(f"Failed to {task} {file_key=}: {e}")
+        return {'key': file_key, 'task': task, 'seconds': round(time.monotonic() - start, 3), 'error': str(e)}
+
+
+def run(task: str, prefix: str, output_path: str, workers: int, api_concurrency: int, limit: int | None):
+    _, validate_mime_type, _, service = TASKS[task]
+    breaker = get_circuit_breaker(service)
+    done = read_checkpoint(output_path)
+    logger.info(f"Resuming with {len(done)} keys already processed" if done else "Starting from scratch")
+    api_slots = threading.Semaphore(api_concurrency)
+    processed, failed, total_bytes = 0, 0, 0
+    start = time.monotonic()
+    unavailable_keys = deque()
+    unavailable_counts: dict[str, int] = {}
+
+    def report():
+        elapsed = time.monotonic() - start
+        logger.info(f"{processed} files ({failed} failed) in {elapsed:.1f}s: {processed / elapsed:.2f} files/s, {total_bytes / elapsed / 1024:.1f} KB/s")
+
+    with open(output_path, 'a', encoding='utf-8') as output, ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+
+        def collect(return_when):
+            nonlocal pending, processed, failed, total_bytes
+            finished, pending = wait(pending, return_when=return_when)
+            for future in finished:
+                record = future.result()
+                if record.pop('unavailable', False):
+                    unavailable_counts[record['key']] = unavailable_counts.get(record['key'], 0) + 1
+                    if unavailable_counts[record['key']] <= UNAVAILABLE_RETRIES:
+                        unavailable_keys.append(record['key'])
+                        continue
+                    record['error'] = f"{POLICIES[service].name} unavailable"
+                output.write(json.dumps(record, ensure_ascii=False) + '\n')
+                processed += 1
+                failed += 'error' in record
+                total_bytes += record.get('bytes', 0)
+                if processed % 100 == 0:
+                    report()
+            output.flush()
+
+        def submit(file_key):
+            # Hold every submission back while the API is unavailable, instead of failing the keys until it's back
+            cooldown = breaker.get_cooldown_remaining()
+            if cooldown > 0:
+                logger.warning(f"{POLICIES[service].name} is unavailable, pausing for {cooldown:.1f}s")
+                time.sleep(cooldown)
+            # Keep the listing streaming instead of queueing every key up front
+            while len(pending) >= workers * 2:
+                collect(FIRST_COMPLETED)
+            pending.add(executor.submit(process_file, task, file_key, api_slots))
+
+        submitted = 0
+        for file_key in list_media_files_from_spaces(prefix=prefix):
+            if file_key in done or not validate_mime_type(file_key.rsplit('.', 1)[-1]):
+                continue
+            if limit is not None and submitted >= limit:
+                break
+            submit(file_key)
+            submitted += 1
+            while unavailable_keys:
+                submit(unavailable_keys.popleft())
+        while pending or unavailable_keys:
+            while unavailable_keys:
+                submit(unavailable_keys.popleft())
+            if pending:
+                collect(FIRST_COMPLETED)
+    if processed:
+        report()
+    return processed, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('task', choices=TASKS.keys(), help="transcribe audios with OpenAI, or OCR images with Azure Vision")
+    parser.add_argument('--prefix', default='media/', help="Only process keys under this prefix (default: media/)")
+    parser.add_argument('--output', required=True, help="JSONL file to append the results to, and to resume from")
+    parser.add_argument('--workers', type=int, default=16, help="Files downloaded and processed at once (default: 16)")
+    parser.add_argument('--api-concurrency', type=int, help="Max concurrent calls to the task's API (default: 4 for transcribe, 8 for ocr)")
+    parser.add_argument('--limit', type=int, help="Stop after submitting this many files")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    api_concurrency = args.api_concurrency or TASKS[args.task][2]
+    processed, failed = run(args.task, args.prefix, args.output, args.workers, api_concurrency, args.limit)
+    print(f"Processed {processed} files, {failed} failed")
@@ -0,0 +1,18 @@
+"""
+One-off migration of the legacy `<key>` + `<key>-timestamp` audit records into the expiring daily audit hashes.
+
+Run from the repo root with the webhook's environment loaded, e.g. `dotenvx run -- python scripts/migrate_audit_records.py`
+"""
+import os
+import sys
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'packages', 'whatsapp', 'webhook'))
+
+from utils.logging import migrate_legacy_audit_records, AUDIT_RETENTION_DAYS
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    migrated, expired = migrate_legacy_audit_records()
+    print(f"Migrated {migrated} audit records, expired {expired} older than {AUDIT_RETENTION_DAYS} days")
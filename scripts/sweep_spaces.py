@@ -0,0 +1,25 @@
+"""
+Delete the media files in DigitalOcean Spaces that are older than the retention period.
+
+Run from the repo root with the webhook's environment loaded, e.g. `dotenvx run -- python scripts/sweep_spaces.py --days 30`
+"""
+import os
+import sys
+import logging
+import argparse
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'packages', 'whatsapp', 'webhook'))
+
+from utils.media import sweep_media_files_from_spaces, STORAGE_RETENTION_DAYS
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--days', type=float, default=STORAGE_RETENTION_DAYS, help="Retention period in days (default: $STORAGE_RETENTION_DAYS or 30)")
+    parser.add_argument('--prefix', default='', help="Only sweep keys under this prefix")
+    parser.add_argument('--dry-run', action='store_true', help="Count the files that would be deleted without deleting them")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    count = sweep_media_files_from_spaces(older_than=timedelta(days=args.days), prefix=args.prefix, dry_run=args.dry_run)
+    print(f"{'Would delete' if args.dry_run else 'Deleted'} {count} media files older than {args.days} days under prefix {args.prefix!r}")